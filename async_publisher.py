@@ -0,0 +1,316 @@
+"""Asyncio publisher engine: many MQTT device connections in one thread.
+
+Every device is a paho client driven by an asyncio event loop through its
+socket callbacks (no loop_start(), so no network thread per client): the
+loop reads the socket when it is readable, writes it when paho has data
+queued and runs the keepalive housekeeping once a second.
+
+Each connection has its own backpressure: at most max_pending messages can
+be handed to paho and not yet written, publish() waits beyond that, and
+while the connection is down. Connections authenticate with the same JWT
+and TLS setup as vehicle.ConnectionManager (rotated before the JWT
+expires) and publish on /devices/{device_id}/events/{vehicle}.
+
+Examples:
+    # 1000 vehicles on 50 device connections against a local broker
+    python async_publisher.py --broker localhost --vehicles 1000 --devices 50 --rate 5000
+"""
+
+# imports
+import argparse, asyncio, json, random, ssl, threading, time
+import paho.mqtt.client as mqtt
+from vehicle import create_jwt, jwt_lifetime
+from columnar_cache import load_cache
+from trajectory import fix_to_payload
+from loadgen import VehicleCursor
+
+
+class _LoopDriver:
+    """Drive a paho client from an asyncio loop (paho socket callbacks).
+
+    The callbacks may run in an executor thread (the connect handshake, see
+    AsyncDevice._connect): the loop is then only touched through
+    call_soon_threadsafe, in the order paho made the calls."""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self._misc = None
+        self._loop_thread = threading.get_ident()
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _call(self, fn, *args):
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._open, sock)
+
+    def _open(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class AsyncDevice:
+    """One device connection on the event loop.
+
+    With private_key_file the device authenticates with a JWT (Google MQTT
+    bridge), with ca_certs the connection uses TLS; without them it is a
+    plain connection to a local broker.
+
+    Args:
+     max_pending: messages handed to paho and not yet written to the socket
+     refresh_margin: seconds before the JWT expires to reconnect with a new one
+    """
+
+    def __init__(
+        self,
+        project_id,
+        cloud_region,
+        registry_id,
+        device_id,
+        private_key_file,
+        algorithm,
+        ca_certs,
+        mqtt_bridge_hostname,
+        mqtt_bridge_port,
+        max_pending=100,
+        refresh_margin=120,
+        minimum_backoff=1.0,
+        maximum_backoff=64.0,
+    ):
+        self.project_id = project_id
+        self.device_id = device_id
+        self.private_key_file = private_key_file
+        self.algorithm = algorithm
+        self.host = mqtt_bridge_hostname
+        self.port = mqtt_bridge_port
+        self.max_pending = max_pending
+        self.refresh_margin = refresh_margin
+        self.minimum_backoff = minimum_backoff
+        self.maximum_backoff = maximum_backoff
+
+        client_id = "projects/{}/locations/{}/registries/{}/devices/{}".format(
+            project_id, cloud_region, registry_id, device_id
+        )
+        self.client = mqtt.Client(client_id=client_id, clean_session=True)
+        if ca_certs:
+            self.client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.topic = "/devices/{}/events".format(device_id)
+
+        self._connected = None
+        self._slots = None
+        self._pending = 0
+        self._token_expiry = None
+        self._task = None
+        self._ever_connected = False
+        # counters
+        self.published = 0
+        self.waits = 0
+        self.reconnects = 0
+        self.refreshes = 0
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected.set()
+        else:
+            print("Device {}: connection refused, {}".format(self.device_id, mqtt.connack_string(rc)))
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected.clear()
+        # paho drops the unsent qos 0 messages with the connection
+        for _ in range(self._pending):
+            self._slots.release()
+        self._pending = 0
+
+    def _on_publish(self, client, userdata, mid):
+        if self._pending:
+            self._pending -= 1
+            self._slots.release()
+
+    async def _connect(self):
+        # the RSA signing and the TCP and TLS handshakes block: they run in the
+        # default executor so a slow broker does not stall the other devices,
+        # then the socket is handed to the loop
+        loop = asyncio.get_running_loop()
+        if self.private_key_file:
+            token = await loop.run_in_executor(None, create_jwt, self.project_id, self.private_key_file, self.algorithm)
+            self.client.username_pw_set(username="unused", password=token)
+            self._token_expiry = time.monotonic() + jwt_lifetime.total_seconds()
+        await loop.run_in_executor(None, self.client.connect, self.host, self.port)
+
+    async def _supervise(self):
+        """Keep the connection up: reconnect with jittered backoff after a
+        disconnect and rotate onto a new JWT before the current one expires."""
+        attempts = 0
+        while True:
+            if not self._connected.is_set():
+                if attempts:
+                    delay = min(self.maximum_backoff, self.minimum_backoff * 2 ** (attempts - 1))
+                    await asyncio.sleep(random.uniform(self.minimum_backoff, max(self.minimum_backoff, delay)))
+                attempts += 1
+                try:
+                    await self._connect()
+                except OSError as e:
+                    print("Device {}: connect failed: {}".format(self.device_id, e))
+                    continue
+                try:
+                    await asyncio.wait_for(self._connected.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    self.client.disconnect()
+                    continue
+                if self._ever_connected:
+                    self.reconnects += 1
+                self._ever_connected = True
+                attempts = 0
+            if self._token_expiry is not None and self._token_expiry - time.monotonic() < self.refresh_margin:
+                self.refreshes += 1
+                self.client.disconnect()
+                self._connected.clear()
+                # let the loop write the DISCONNECT before reconnecting
+                await asyncio.sleep(0.1)
+                continue
+            await asyncio.sleep(1)
+
+    async def start(self):
+        """Connect on the running loop, returns once connected."""
+        loop = asyncio.get_running_loop()
+        _LoopDriver(loop, self.client)
+        self._connected = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._task = loop.create_task(self._supervise())
+        await self._connected.wait()
+        return self
+
+    async def publish(self, vehicle, payload, qos=0):
+        """Publish on /devices/{device_id}/events/{vehicle}, waiting for a
+        free slot and for the connection."""
+        if self._slots.locked():
+            self.waits += 1
+        await self._slots.acquire()
+        await self._connected.wait()
+        self._pending += 1
+        info = self.client.publish("{}/{}".format(self.topic, vehicle), payload=payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            # not queued by paho: on_publish will not run
+            self._pending -= 1
+            self._slots.release()
+            return False
+        self.published += 1
+        return True
+
+    async def drain(self, timeout=10.0):
+        """Wait until every pending message is written."""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        await self.drain()
+        if self._task is not None:
+            self._task.cancel()
+        self.client.disconnect()
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "pending": self._pending,
+            "backpressure_waits": self.waits,
+            "reconnects": self.reconnects,
+            "jwt_refreshes": self.refreshes,
+        }
+
+
+async def _replay(device, cursors, rate, stop):
+    """Publish the fixes of the device's vehicles round-robin at `rate`
+    messages per second (0: as fast as the connection takes them)."""
+    sent = 0
+    start = time.monotonic()
+    while time.monotonic() < stop:
+        if rate:
+            delay = start + sent / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        fix = cursors[sent % len(cursors)].next_fix()
+        await device.publish(fix.vehicle, json.dumps(fix_to_payload(fix)).encode("UTF-8"))
+        sent += 1
+    return sent
+
+
+async def run_engine(devices, vehicles, rate, duration):
+    """Connect the devices, share the vehicles among them and replay for
+    `duration` seconds at an aggregate `rate`. Returns per-device stats."""
+    cache = load_cache()
+    await asyncio.gather(*(d.start() for d in devices))
+    shares = [vehicles[i::len(devices)] for i in range(len(devices))]
+    stop = time.monotonic() + duration
+    start = time.monotonic()
+    jobs = [
+        _replay(d, [VehicleCursor(cache, v) for v in share], rate * len(share) / len(vehicles), stop)
+        for d, share in zip(devices, shares) if share
+    ]
+    sent = await asyncio.gather(*jobs)
+    await asyncio.gather(*(d.stop() for d in devices))
+    elapsed = time.monotonic() - start
+    print("Engine: {} fixes from {} vehicles on {} connections in {:.2f}s: {:.0f} msg/s".format(
+        sum(sent), len(vehicles), len(devices), elapsed, sum(sent) / elapsed if elapsed else 0.0))
+    return [d.stats() for d in devices]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Asyncio MQTT publisher: many device connections in one process.")
+    parser.add_argument("--vehicles", type=int, default=200, help="number of vehicles (above 200 are synthetic)")
+    parser.add_argument("--devices", type=int, default=10, help="device connections")
+    parser.add_argument("--rate", type=float, default=1000.0, help="target aggregate messages per second (0: unbounded)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--max-pending", type=int, default=100, help="unwritten messages per connection")
+    parser.add_argument("--broker", default="mqtt.googleapis.com", help="MQTT broker host")
+    parser.add_argument("--port", type=int, default=8883, help="MQTT broker port")
+    parser.add_argument("--project", default="pccreverselogistic", help="cloud project of the devices")
+    parser.add_argument("--region", default="europe-west1", help="cloud region of the registry")
+    parser.add_argument("--registry", default="vehicles", help="device registry")
+    parser.add_argument("--device-prefix", default="vehicle", help="device ids are prefix001, prefix002, ...")
+    parser.add_argument("--private-key", default=None, help="RSA private key of the devices (JWT auth)")
+    parser.add_argument("--ca-certs", default=None, help="CA roots for TLS, e.g. p_keys/ca/roots.cer")
+    args = parser.parse_args(argv)
+
+    devices = [
+        AsyncDevice(args.project, args.region, args.registry, "{}{:03d}".format(args.device_prefix, i + 1),
+                    args.private_key, "RS256", args.ca_certs, args.broker, args.port, max_pending=args.max_pending)
+        for i in range(args.devices)
+    ]
+    stats = asyncio.run(run_engine(devices, list(range(1, args.vehicles + 1)), args.rate, args.duration))
+    waits = sum(s["backpressure_waits"] for s in stats)
+    print("Backpressure waits: {}, reconnects: {}".format(waits, sum(s["reconnects"] for s in stats)))
+    return stats
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# imports
+import itertools, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from batching import decode_payload, payload_to_row
+import metrics
+
+# numbers the consumers of the process, label of their gauge
+_instances = itertools.count(1)
+
+
+class BatchConsumer:
+    """Group the fixes of a Pub/Sub stream into micro-batches for a sink.
+
+    consume() is the subscription callback: it decodes the message (single or
+    batched fixes) and adds its rows to the current batch. A batch is handed
+    to a worker thread when it holds max_rows rows or its first message waited
+    max_latency seconds. The worker calls sink(rows); only when it succeeds are
+    all the messages of the batch acked, otherwise they are nacked and Pub/Sub
+    redelivers them.
+
+    Throughput and end-to-end lag (from the Pub/Sub publish time to the sink
+    success) are kept in stats() and printed every report_interval seconds,
+    and recorded as metrics when they are enabled (see metrics.py).
+
+    Args:
+     sink: callable taking a list of BigQuery-style rows (see batching.payload_to_row)
+     max_rows: rows per batch
+     max_latency: seconds a message can wait before its batch is flushed
+     workers: threads running the sink
+    """
+
+    def __init__(self, sink, max_rows=500, max_latency=1.0, workers=4, report_interval=10.0):
+        self.sink = sink
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.report_interval = report_interval
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sink")
+        self._lock = threading.Lock()
+        self._rows = []
+        self._messages = []
+        self._started = None
+        self._closed = threading.Event()
+        # counters
+        self.received = 0
+        self.stored = 0
+        self.batches = 0
+        self.failed = 0
+        self.acked = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        registry = metrics.registry
+        self._rows_stored = registry.counter("subscriber_rows_stored_total", "rows written by the sink")
+        self._failed_batches = registry.counter("subscriber_failed_batches_total", "batches nacked after a sink error")
+        self._batch_rows = registry.histogram("subscriber_batch_rows", "rows per sink batch", metrics.size_buckets)
+        self._lag = registry.histogram("subscriber_lag_seconds", "Pub/Sub publish time to sink success")
+        # one series per consumer, removed by close() (the fn keeps the consumer alive)
+        self._pending_rows = lambda: len(self._rows)
+        self._gauge_labels = {"consumer": str(next(_instances))}
+        self._pending_gauge = registry.gauge("subscriber_pending_rows", "rows waiting in the current batch",
+                                             fn=self._pending_rows, labels=self._gauge_labels)
+        self._start = time.monotonic()
+        self._next_report = self._start + report_interval
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def consume(self, message):
+        """Pub/Sub callback."""
+        if self._closed.is_set():
+            # arrived while shutting down, no batch will take it
+            message.nack()
+            return
+        try:
+            rows = [payload_to_row(p) for p in decode_payload(message.data)]
+        except Exception as e:
+            # undecodable message: redelivering it would not help
+            print(f"Dropping bad message {message.message_id}: {e}")
+            message.ack()
+            return
+        ready = None
+        with self._lock:
+            self.received += len(rows)
+            if not self._messages:
+                self._started = time.monotonic()
+            self._rows.extend(rows)
+            self._messages.append(message)
+            if len(self._rows) >= self.max_rows:
+                ready = self._take()
+        if ready:
+            self._pool.submit(self._store, *ready)
+
+    def _take(self):
+        ready = (self._rows, self._messages)
+        self._rows, self._messages = [], []
+        return ready
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.max_latency / 4):
+            ready = None
+            with self._lock:
+                if self._messages and time.monotonic() - self._started >= self.max_latency:
+                    ready = self._take()
+            if ready:
+                self._pool.submit(self._store, *ready)
+            if self.report_interval and time.monotonic() >= self._next_report:
+                self.report()
+                self._next_report = time.monotonic() + self.report_interval
+
+    def _store(self, rows, messages):
+        try:
+            self.sink(rows)
+        except Exception as e:
+            print(f"Sink failed on a batch of {len(rows)} rows: {e}")
+            for message in messages:
+                message.nack()
+            with self._lock:
+                self.failed += 1
+            self._failed_batches.inc()
+            return
+        for message in messages:
+            message.ack()
+        now = time.time()
+        lags = [now - m.publish_time.timestamp() for m in messages]
+        with self._lock:
+            self.stored += len(rows)
+            self.batches += 1
+            self.total_lag += sum(lags)
+            self.max_lag = max(self.max_lag, max(lags))
+            self.acked += len(messages)
+        self._rows_stored.inc(len(rows))
+        self._batch_rows.observe(len(rows))
+        for lag in lags:
+            self._lag.observe(lag)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._start
+        with self._lock:
+            return {
+                "received": self.received,
+                "stored": self.stored,
+                "batches": self.batches,
+                "failed_batches": self.failed,
+                "rows_per_second": self.stored / elapsed if elapsed else 0.0,
+                "mean_batch": self.stored / self.batches if self.batches else 0.0,
+                "mean_lag": self.total_lag / self.acked if self.acked else 0.0,
+                "max_lag": self.max_lag,
+            }
+
+    def report(self):
+        s = self.stats()
+        print("Consumer: {} rows stored in {} batches ({:.0f} rows/s, mean batch {:.0f}), lag mean {:.3f}s max {:.3f}s".format(
+            s["stored"], s["batches"], s["rows_per_second"], s["mean_batch"], s["mean_lag"], s["max_lag"]))
+
+    def close(self):
+        """Flush the current batch and wait for the sink workers (again: no-op)."""
+        self._closed.set()
+        self._thread.join()
+        with self._lock:
+            ready = self._take() if self._messages else None
+        if ready:
+            self._pool.submit(self._store, *ready)
+        self._pool.shutdown(wait=True)
+        self._pending_gauge.remove(self._gauge_labels, self._pending_rows)
@@ -0,0 +1,156 @@
+# imports
+import json, struct, threading, time
+from codec import codecs, decode_fixes, payload_to_fix
+from trajectory import fix_to_payload
+
+# payload formats of a batch, besides the codecs in codec.py ("struct", "delta")
+JSON_ARRAY = "json"
+BINARY = "binary"
+
+# first byte of a length-prefixed binary batch. JSON text never starts with
+# a control byte, so single messages and JSON arrays are told apart by '{'/'['
+BINARY_BATCH = 0x01
+
+# length prefix of each record in a binary batch
+_record_length = struct.Struct(">H")
+
+
+def encode_batch(payloads, format=JSON_ARRAY):
+    """Encode a list of fix payloads (dicts) as one message body.
+
+    JSON_ARRAY: a compact JSON array of the payloads.
+    BINARY: 0x01 followed by every payload as a 2-byte big-endian length and
+    its compact JSON encoding.
+    Any other codec name of codec.py encodes the fixes with that codec.
+    """
+    if format == JSON_ARRAY:
+        return json.dumps(payloads, separators=(",", ":")).encode(encoding="UTF-8")
+    if format == BINARY:
+        records = [json.dumps(p, separators=(",", ":")).encode(encoding="UTF-8") for p in payloads]
+        return bytes([BINARY_BATCH]) + b"".join(_record_length.pack(len(r)) + r for r in records)
+    if format in codecs:
+        return codecs[format].encode([payload_to_fix(p) for p in payloads])
+    raise ValueError("Unknown batch format {}".format(format))
+
+
+def decode_payload(data):
+    """Decode a message body into the list of fix payloads it carries.
+    Accepts single JSON messages, JSON array and binary batches and the
+    binary codecs of codec.py."""
+    if data[:1] == bytes([BINARY_BATCH]):
+        payloads = []
+        view = memoryview(data)
+        i = 1
+        while i < len(view):
+            (length,) = _record_length.unpack_from(view, i)
+            i += _record_length.size
+            payloads.append(json.loads(bytes(view[i:i + length])))
+            i += length
+        return payloads
+    if data[:1] in (b"{", b"["):
+        decoded = json.loads(data)
+        return decoded if isinstance(decoded, list) else [decoded]
+    return [fix_to_payload(f) for f in decode_fixes(data)]
+
+
+def payload_to_row(payload):
+    """BigQuery row of the positions table for a fix payload."""
+    return {
+        "vehicle": int(payload["vehicle"]),
+        "timestamp": payload["timestamp"],
+        "lat": float(payload["lat"]),
+        "lon": float(payload["lon"]),
+    }
+
+
+class BatchingPublisher:
+    """Coalesce fixes per topic and publish them as one message.
+
+    A topic buffer is flushed when it holds max_messages fixes, when its
+    encoded size would exceed max_bytes, or when its oldest fix has waited
+    max_latency seconds (checked by a background thread, so a quiet replay
+    still delivers on time). Stats compare fixes and bytes before batching
+    with messages and bytes actually published.
+
+    Args:
+     client: the paho client (or anything with a compatible publish())
+     max_messages: fixes per batch
+     max_bytes: size limit of a batch message
+     max_latency: seconds a fix can wait in the buffer
+     format: JSON_ARRAY, BINARY or a codec name ("struct", "delta")
+    """
+
+    def __init__(self, client, max_messages=50, max_bytes=16 * 1024, max_latency=1.0, format=JSON_ARRAY, qos=0):
+        self.client = client
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.format = format
+        self.qos = qos
+        # topic -> [time of the oldest fix, payloads, approximate size]
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        # fixes and single-message bytes (before) vs published messages and bytes (after)
+        self.fixes = 0
+        self.fix_bytes = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def start(self):
+        """Start the thread flushing buffers older than max_latency."""
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.max_latency / 2):
+            self.flush(expired_only=True)
+
+    def publish(self, topic, payload):
+        """Buffer a fix payload (dict) for topic."""
+        single = len(json.dumps(payload, separators=(",", ":"))) + 2
+        ready = []
+        with self._lock:
+            self.fixes += 1
+            self.fix_bytes += single - 2
+            buffer = self._buffers.get(topic)
+            if buffer is not None and buffer[2] + single > self.max_bytes:
+                ready.append(self._buffers.pop(topic)[1])
+                buffer = None
+            if buffer is None:
+                buffer = self._buffers[topic] = [time.monotonic(), [], 1]
+            buffer[1].append(payload)
+            buffer[2] += single
+            if len(buffer[1]) >= self.max_messages:
+                ready.append(self._buffers.pop(topic)[1])
+        for payloads in ready:
+            self._send(topic, payloads)
+
+    def _send(self, topic, payloads):
+        body = encode_batch(payloads, self.format)
+        self.client.publish(topic, payload=body, qos=self.qos, retain=False)
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(body)
+
+    def flush(self, expired_only=False):
+        """Publish buffered fixes (only those older than max_latency if expired_only)."""
+        now = time.monotonic()
+        with self._lock:
+            topics = [t for t, (started, _, _) in self._buffers.items()
+                      if not expired_only or now - started >= self.max_latency]
+            ready = [(t, self._buffers.pop(t)[1]) for t in topics]
+        for topic, payloads in ready:
+            self._send(topic, payloads)
+
+    def close(self):
+        """Stop the flush thread and publish everything still buffered."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        return {"fixes": self.fixes, "fix_bytes": self.fix_bytes, "messages": self.messages, "bytes": self.bytes}
@@ -0,0 +1,221 @@
+"""Offline benchmarks of the hot paths, against vehicles_data and fake services.
+
+Sections:
+    replay      trajectory file reads (rows/s) and the scheduler merge at full speed
+    encode      payload encode/decode ns per fix of every codec (see codec.py)
+    publish     msgs/s through a paho client to a local broker, or the in-process fake
+    nearest     nearest-vehicle query latency with 20, 200 and 20k vehicles
+    subscriber  BatchConsumer throughput with fake Pub/Sub messages
+    ingest      PositionsWriter rows/s against the fake BigQuery transport
+
+Results are flat {"section/metric": value} JSON, so two runs can be diffed.
+Metrics are compared with a baseline by their name: "*_per_second" are better
+higher, "*_ns", "*latency*" and "*seconds" better lower.
+
+Examples:
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.15
+    python benchmark.py --only publish --broker localhost
+"""
+
+# imports
+import argparse, datetime, json, sys, time
+import numpy as np
+from columnar_cache import load_cache
+from trajectory import data_dir, open_cursors, fix_to_payload
+from replay import ReplayScheduler
+from codec import benchmark_codecs, get_codec
+from loadgen import connect
+from batching import encode_batch, JSON_ARRAY
+from bigquery_writer import benchmark_writer
+from spatial_index import SpatialIndex
+from batch_consumer import BatchConsumer
+
+sections = ["replay", "encode", "publish", "nearest", "subscriber", "ingest"]
+
+
+def _percentiles(samples, prefix):
+    samples = np.sort(np.asarray(samples))
+    return {
+        prefix + "_p50": float(samples[len(samples) // 2]),
+        prefix + "_p99": float(samples[int(len(samples) * 0.99)]),
+    }
+
+
+def bench_replay(cache):
+    vehicles = [int(v) for v in cache.vehicles]
+    start = time.perf_counter()
+    rows = 0
+    for cursor in open_cursors(vehicles, data_dir).values():
+        for _ in cursor:
+            rows += 1
+        cursor.close()
+    read = time.perf_counter() - start
+
+    scheduler = ReplayScheduler(open_cursors(vehicles, data_dir).values(), speedup=0, report_interval=0)
+    start = time.perf_counter()
+    scheduler.run(lambda fix: None)
+    merged = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "read_rows_per_second": rows / read,
+        "merge_rows_per_second": scheduler.emitted / merged,
+    }
+
+
+def bench_encode(cache):
+    results = {}
+    for key, r in benchmark_codecs().items():
+        for metric, value in r.items():
+            results["{}/{}".format(key, metric)] = value
+    return results
+
+
+def bench_publish(cache, broker=None, port=1883, messages=50000):
+    client = connect("benchmark", broker, port)
+    codec = get_codec("json")
+    fixes = [cache.fix(i) for i in range(min(messages, len(cache)))]
+    bodies = [("/devices/benchmark/events/{}".format(f.vehicle), codec.encode([f])) for f in fixes]
+    start = time.perf_counter()
+    last = None
+    for topic, body in bodies:
+        last = client.publish(topic, payload=body, qos=0)
+    if broker is not None:
+        # qos 0 messages are written by the network loop, wait for the last one
+        last.wait_for_publish()
+    elapsed = time.perf_counter() - start
+    client.loop_stop()
+    client.disconnect()
+    return {"messages": len(bodies), "msgs_per_second": len(bodies) / elapsed}
+
+
+def bench_nearest(cache, sizes=(20, 200, 20000), queries=2000):
+    # fleet positions drawn from the real fixes, queries around Beijing
+    rng = np.random.default_rng(0)
+    lat, lon = np.asarray(cache.lat), np.asarray(cache.lon)
+    inside = np.flatnonzero((lat > 39.4) & (lat < 40.4) & (lon > 115.8) & (lon < 117.0))
+    results = {}
+    for n in sizes:
+        rows = rng.choice(inside, size=n, replace=n > len(inside))
+        start = time.perf_counter()
+        index = SpatialIndex()
+        for vehicle, i in enumerate(rows.tolist(), start=1):
+            index.update(vehicle, float(lat[i]), float(lon[i]))
+        build = time.perf_counter() - start
+        q = rng.choice(inside, size=queries)
+        latencies = []
+        for i in q.tolist():
+            t = time.perf_counter()
+            index.nearest(float(lat[i]), float(lon[i]))
+            latencies.append((time.perf_counter() - t) * 1e6)
+        results["{}/build_seconds".format(n)] = build
+        results.update(_percentiles(latencies, "{}/query_latency_us".format(n)))
+    return results
+
+
+class FakeMessage:
+    """Pub/Sub message stand-in for BatchConsumer."""
+
+    def __init__(self, data, message_id):
+        self.data = data
+        self.message_id = message_id
+        self.publish_time = datetime.datetime.now(datetime.timezone.utc)
+
+    def ack(self):
+        pass
+
+    def nack(self):
+        pass
+
+
+def bench_subscriber(cache, messages=50000, batch=20):
+    payloads = [fix_to_payload(cache.fix(i)) for i in range(min(messages * batch, len(cache)))]
+    bodies = [encode_batch(payloads[i:i + batch], JSON_ARRAY) for i in range(0, len(payloads), batch)]
+    consumer = BatchConsumer(lambda rows: None, max_rows=500, max_latency=0.5, report_interval=0)
+    start = time.perf_counter()
+    for i, body in enumerate(bodies):
+        consumer.consume(FakeMessage(body, str(i)))
+    consumer.close()
+    elapsed = time.perf_counter() - start
+    return {
+        "messages": len(bodies),
+        "rows_per_second": consumer.stats()["stored"] / elapsed,
+        "msgs_per_second": len(bodies) / elapsed,
+    }
+
+
+def bench_ingest(cache):
+    r = benchmark_writer()
+    return {"rows_per_second": r["rows_per_second"], "latency_p50": r["latency_p50"], "latency_p99": r["latency_p99"]}
+
+
+def run(only=None, broker=None, port=1883):
+    """Run the benchmark sections, returns {"section/metric": value}."""
+    cache = load_cache()
+    benches = {
+        "replay": lambda: bench_replay(cache),
+        "encode": lambda: bench_encode(cache),
+        "publish": lambda: bench_publish(cache, broker, port),
+        "nearest": lambda: bench_nearest(cache),
+        "subscriber": lambda: bench_subscriber(cache),
+        "ingest": lambda: bench_ingest(cache),
+    }
+    results = {}
+    for name in only or sections:
+        start = time.perf_counter()
+        for metric, value in benches[name]().items():
+            results["{}/{}".format(name, metric)] = value
+        print("Benchmark {}: done in {:.1f}s".format(name, time.perf_counter() - start))
+    return results
+
+
+def _direction(metric):
+    """+1 if higher is better, -1 if lower is better, 0 if not comparable."""
+    if metric.endswith("_per_second"):
+        return 1
+    if metric.endswith("_ns") or metric.endswith("seconds") or "latency" in metric:
+        return -1
+    return 0
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Changes against a baseline, returns (rows, regressions). A metric
+    regresses when it is worse than the baseline by more than tolerance."""
+    rows, regressions = [], []
+    for metric, value in sorted(results.items()):
+        direction = _direction(metric)
+        old = baseline.get(metric)
+        if not direction or not old:
+            continue
+        change = (value - old) / old
+        rows.append((metric, old, value, change))
+        if change * direction < -tolerance:
+            regressions.append(metric)
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the replay, publish, query and ingest paths.")
+    parser.add_argument("--only", nargs="+", choices=sections, help="sections to run (default: all)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--broker", default=None, help="local MQTT broker host for publish (default: in-process fake)")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    args = parser.parse_args()
+
+    results = run(args.only, args.broker, args.port)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=1, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(results, baseline, args.tolerance)
+        for metric, old, new, change in rows:
+            flag = " REGRESSION" if metric in regressions else ""
+            print("{:50} {:14.4g} -> {:14.4g} {:+7.1%}{}".format(metric, old, new, change, flag))
+        sys.exit(1 if regressions else 0)
@@ -1,11 +1,12 @@
-from bisect import bisect
+import datetime
 from google.cloud import bigquery, exceptions
 from google.cloud.bigquery.enums import EntityTypes
+from client_registry import shared_client
 
-def create_dataset_and_table(service_account_json, project_id, dataset, table):
+def create_dataset(service_account_json, project_id, dataset):
 
     # init client
-    client = bigquery.Client.from_service_account_json(service_account_json)
+    client = shared_client(bigquery.Client, service_account_json)
     # create dataset string
     dataset_string = bigquery.Dataset(dataset_ref=f"{project_id}.{dataset}")
 
@@ -43,19 +44,49 @@ def create_dataset_and_table(service_account_json, project_id, dataset, table):
 
             print("Updated dataset '{}' with modified user permissions for {}".format(full_dataset_id, entity_id))
         print(f"Bigquery dataset: {dataset} ok.")
+        return createdDataset
     except Exception as e:
         print(e.message)
+        return e
+
+# schema of the positions and latest positions tables
+schema = [
+    bigquery.SchemaField(name="vehicle", field_type="INTEGER", description="Vehicle ID"),
+    bigquery.SchemaField(name="timestamp", field_type="TIMESTAMP", description="Publication Time"),
+    bigquery.SchemaField(name="lat", field_type="FLOAT", description="Latitude"),
+    bigquery.SchemaField(name="lon", field_type="FLOAT", description="Longitude"),
+]
 
-    # creating the new schema
-    schema = [
-        bigquery.SchemaField(name="vehicle", field_type="INTEGER", description="Vehicle ID"),
-        bigquery.SchemaField(name="timestamp", field_type="TIMESTAMP", description="Publication Time"),
-        bigquery.SchemaField(name="lat", field_type="FLOAT", description="Latitude"),
-        bigquery.SchemaField(name="lon", field_type="FLOAT", description="Longitude"),
-    ]
+def create_table(service_account_json, project_id, dataset, table, partitioned=True):
+
+    # init client
+    client = shared_client(bigquery.Client, service_account_json)
 
     # defining the new table
-    table_req = bigquery.Table(table_ref=f"{project_id}.{createdDataset.dataset_id}.{table}", schema=schema)
+    table_req = bigquery.Table(table_ref=f"{project_id}.{dataset}.{table}", schema=schema)
+
+    if partitioned:
+        # daily partitions on the fix time and clustering by vehicle: time-bounded
+        # queries only read the matching partitions and blocks. An existing
+        # unpartitioned table is left as it is (it has to be recreated)
+        table_req.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="timestamp")
+        table_req.clustering_fields = ["vehicle"]
+
+    try:
+        table = client.create_table(table=table_req, exists_ok=True)
+        print(f"Bigquery table: {table.table_id} ok...")
+        return table
+    except Exception as e:
+        return e
+
+def create_latest_table(service_account_json, project_id, dataset, latest_table):
+
+    # init client
+    client = shared_client(bigquery.Client, service_account_json)
+
+    # one row per vehicle, kept by the scheduled query (create_latest_positions_schedule)
+    table_req = bigquery.Table(table_ref=f"{project_id}.{dataset}.{latest_table}", schema=schema)
+    table_req.clustering_fields = ["vehicle"]
 
     try:
         table = client.create_table(table=table_req, exists_ok=True)
@@ -64,4 +95,81 @@ def create_dataset_and_table(service_account_json, project_id, dataset, table):
     except Exception as e:
         return e
 
-    
\ No newline at end of file
+def latest_positions_sql(project_id, dataset, table, latest_table, lookback_hours=1):
+    """Script merging the newest fix of every vehicle into the latest table.
+
+    Only the positions newer than the latest table's newest fix (minus
+    lookback_hours, for late rows) are read: the bound is a script variable,
+    so BigQuery prunes the older partitions and a refresh scans a roughly
+    constant amount of data. Materialized views can not keep "the newest
+    row per vehicle" incrementally, hence the MERGE, run as a scheduled
+    query (see create_latest_positions_schedule) or with refresh_latest_positions."""
+    positions = f"`{project_id}.{dataset}.{table}`"
+    latest = f"`{project_id}.{dataset}.{latest_table}`"
+    return f"""
+        DECLARE since TIMESTAMP DEFAULT (
+            SELECT TIMESTAMP_SUB(IFNULL(max(timestamp), TIMESTAMP '1970-01-01'), INTERVAL {int(lookback_hours)} HOUR) FROM {latest}
+        );
+        MERGE {latest} AS l
+        USING (
+            SELECT vehicle, ARRAY_AGG(STRUCT(timestamp, lat, lon) ORDER BY timestamp DESC LIMIT 1)[OFFSET(0)] AS fix
+            FROM {positions}
+            WHERE timestamp >= since
+            GROUP BY vehicle
+        ) AS p
+        ON l.vehicle = p.vehicle
+        WHEN MATCHED AND p.fix.timestamp > l.timestamp THEN
+            UPDATE SET timestamp = p.fix.timestamp, lat = p.fix.lat, lon = p.fix.lon
+        WHEN NOT MATCHED THEN
+            INSERT (vehicle, timestamp, lat, lon) VALUES (p.vehicle, p.fix.timestamp, p.fix.lat, p.fix.lon);
+    """
+
+def refresh_latest_positions(service_account_json, project_id, dataset, table, latest_table):
+
+    # init client
+    client = shared_client(bigquery.Client, service_account_json)
+
+    job = client.query(latest_positions_sql(project_id, dataset, table, latest_table))
+    job.result()
+    print(f"Bigquery table: {latest_table} refreshed, {job.total_bytes_processed} bytes processed")
+    return job
+
+def create_latest_positions_schedule(service_account_json, project_id, dataset, table, latest_table, schedule="every 5 minutes"):
+    """Scheduled query keeping the latest table current (the MERGE of
+    latest_positions_sql), created once: an existing one with the same name
+    is kept. 5 minutes is the shortest schedule BigQuery accepts."""
+    from google.cloud import bigquery_datatransfer
+
+    # init client
+    client = shared_client(bigquery_datatransfer.DataTransferServiceClient, service_account_json)
+
+    parent = client.common_project_path(project_id)
+    display_name = f"refresh {dataset}.{latest_table}"
+    try:
+        for config in client.list_transfer_configs(parent=parent):
+            if config.display_name == display_name:
+                print(f"Bigquery scheduled query: {display_name} ok...")
+                return config
+
+        config = bigquery_datatransfer.TransferConfig(
+            display_name=display_name,
+            data_source_id="scheduled_query",
+            params={"query": latest_positions_sql(project_id, dataset, table, latest_table)},
+            schedule=schedule,
+        )
+        config = client.create_transfer_config(parent=parent, transfer_config=config)
+        # fill the table now instead of at the first scheduled run
+        client.start_manual_transfer_runs(
+            request={"parent": config.name, "requested_run_time": datetime.datetime.now(datetime.timezone.utc)}
+        )
+        print(f"Bigquery scheduled query: {display_name} created, {schedule}")
+        return config
+    except Exception as e:
+        return e
+
+def create_dataset_and_table(service_account_json, project_id, dataset, table):
+
+    # the dataset must exist before creating a table
+    create_dataset(service_account_json, project_id, dataset)
+    return create_table(service_account_json, project_id, dataset, table)
+
@@ -0,0 +1,279 @@
+# imports
+import time, datetime, threading
+from collections import OrderedDict
+from google.api_core import exceptions
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+# errors worth retrying an append for
+retryable_errors = (
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.TooManyRequests,
+)
+
+
+def _row_descriptor():
+    """Proto message of a row of the positions table (see bigquery.create_table).
+    TIMESTAMP columns are written as int64 microseconds since the epoch."""
+    message = descriptor_pb2.DescriptorProto(name="PositionRow")
+    fields = [
+        ("vehicle", descriptor_pb2.FieldDescriptorProto.TYPE_INT64),
+        ("timestamp", descriptor_pb2.FieldDescriptorProto.TYPE_INT64),
+        ("lat", descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE),
+        ("lon", descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE),
+    ]
+    for number, (name, field_type) in enumerate(fields, start=1):
+        message.field.add(name=name, number=number, type=field_type,
+                          label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+    return message
+
+
+def _row_class(message):
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(descriptor_pb2.FileDescriptorProto(name="position_row.proto", syntax="proto2", message_type=[message]))
+    descriptor = pool.FindMessageTypeByName("PositionRow")
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+row_descriptor = _row_descriptor()
+PositionRow = _row_class(row_descriptor)
+
+
+def _micros(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp() * 1000000)
+
+
+def serialize_rows(rows):
+    """Proto serialization of positions rows (dicts as batching.payload_to_row)."""
+    return [
+        PositionRow(vehicle=r["vehicle"], timestamp=_micros(r["timestamp"]), lat=r["lat"], lon=r["lon"]).SerializeToString()
+        for r in rows
+    ]
+
+
+class StorageWriteTransport:
+    """Append serialized rows to the default stream of a table with the
+    BigQuery Storage Write API. Rows on the default stream are queryable as
+    soon as the append returns.
+
+    A failed append closes the stream (server close, network error): the
+    stream is then rebuilt from the template and the error raised, as a
+    retryable ServiceUnavailable when it did not come from the API, so
+    PositionsWriter retries it on the new stream."""
+
+    def __init__(self, project_id, dataset, table, service_account_json=None):
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        self._types = types
+        self._writer = writer
+        if service_account_json:
+            self.client = bigquery_storage_v1.BigQueryWriteClient.from_service_account_file(service_account_json)
+        else:
+            self.client = bigquery_storage_v1.BigQueryWriteClient()
+        template = types.AppendRowsRequest()
+        template.write_stream = "{}/streams/_default".format(self.client.table_path(project_id, dataset, table))
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = types.ProtoSchema(proto_descriptor=row_descriptor)
+        template.proto_rows = proto_data
+        self._template = template
+        self._stream = writer.AppendRowsStream(self.client, template)
+        # the stream accepts one request at a time per connection
+        self._lock = threading.Lock()
+        # counters
+        self.reopened = 0
+
+    def _reopen(self, failed):
+        """Replace the stream that failed, unless another append already did."""
+        with self._lock:
+            if self._stream is not failed:
+                return
+            try:
+                failed.close()
+            except Exception:
+                pass
+            self._stream = self._writer.AppendRowsStream(self.client, self._template)
+            self.reopened += 1
+
+    def append(self, serialized_rows):
+        proto_data = self._types.AppendRowsRequest.ProtoData()
+        proto_data.rows = self._types.ProtoRows(serialized_rows=serialized_rows)
+        request = self._types.AppendRowsRequest(proto_rows=proto_data)
+        try:
+            with self._lock:
+                stream = self._stream
+                future = stream.send(request)
+            # raises the append error, if any
+            future.result()
+        except exceptions.GoogleAPICallError:
+            self._reopen(stream)
+            raise
+        except Exception as e:
+            self._reopen(stream)
+            raise exceptions.ServiceUnavailable("append stream failed: {!r}".format(e)) from e
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+
+class FakeTransport:
+    """In-memory stand-in for the positions table: appends are parsed back
+    into rows, made queryable after `visibility_delay` seconds and fail with
+    ServiceUnavailable every `fail_every` appends (0: never)."""
+
+    def __init__(self, append_latency=0.0, visibility_delay=0.0, fail_every=0):
+        self.append_latency = append_latency
+        self.visibility_delay = visibility_delay
+        self.fail_every = fail_every
+        self.appends = 0
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def append(self, serialized_rows):
+        with self._lock:
+            self.appends += 1
+            failing = self.fail_every and self.appends % self.fail_every == 0
+        if self.append_latency:
+            time.sleep(self.append_latency)
+        if failing:
+            raise exceptions.ServiceUnavailable("fake append failure")
+        visible = time.monotonic() + self.visibility_delay
+        rows = []
+        for data in serialized_rows:
+            row = PositionRow()
+            row.ParseFromString(data)
+            rows.append((visible, row))
+        with self._lock:
+            self._rows.extend(rows)
+
+    def __len__(self):
+        """Rows stored, queryable or not yet."""
+        with self._lock:
+            return len(self._rows)
+
+    def query(self):
+        """Rows queryable now."""
+        now = time.monotonic()
+        with self._lock:
+            return [row for visible, row in self._rows if visible <= now]
+
+    def close(self):
+        pass
+
+
+class PositionsWriter:
+    """Sink writing micro-batches of positions rows through a transport.
+
+    Rows already written or being written by a concurrent call, keyed by
+    (vehicle, timestamp), are dropped before the append, so Pub/Sub
+    redeliveries and replays do not duplicate rows;
+    the key window is bounded to the last dedupe_window rows. Failed appends
+    are retried with exponential backoff on transient errors, other errors
+    propagate (BatchConsumer then nacks the batch).
+    Usable directly as a BatchConsumer sink: writer(rows).
+    """
+
+    def __init__(self, transport, dedupe_window=100000, retries=5, backoff=0.2):
+        self.transport = transport
+        self.dedupe_window = dedupe_window
+        self.retries = retries
+        self.backoff = backoff
+        self._seen = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        # counters
+        self.written = 0
+        self.duplicates = 0
+        self.retried = 0
+
+    def __call__(self, rows):
+        with self._lock:
+            fresh = {}
+            for r in rows:
+                key = (r["vehicle"], r["timestamp"])
+                if key in self._seen or key in self._pending or key in fresh:
+                    self.duplicates += 1
+                else:
+                    fresh[key] = r
+            # reserved while appending: a concurrent call with the same keys
+            # drops them (if this append fails its batch is nacked and redelivered)
+            self._pending.update(fresh)
+        if not fresh:
+            return 0
+
+        try:
+            serialized = serialize_rows(fresh.values())
+            for attempt in range(self.retries + 1):
+                try:
+                    self.transport.append(serialized)
+                    break
+                except retryable_errors:
+                    if attempt == self.retries:
+                        raise
+                    self.retried += 1
+                    time.sleep(self.backoff * 2 ** attempt)
+        except BaseException:
+            with self._lock:
+                self._pending.difference_update(fresh)
+            raise
+
+        # remember the keys only once the rows are stored
+        with self._lock:
+            self._pending.difference_update(fresh)
+            for key in fresh:
+                self._seen[key] = None
+            while len(self._seen) > self.dedupe_window:
+                self._seen.popitem(last=False)
+            self.written += len(fresh)
+        return len(fresh)
+
+    def close(self):
+        self.transport.close()
+
+    def stats(self):
+        return {"written": self.written, "duplicates": self.duplicates, "retried_appends": self.retried}
+
+
+def benchmark_writer(batch=500, append_latency=0.005, visibility_delay=0.0, fail_every=50):
+    """Rows/sec and ingest-to-queryable latency of PositionsWriter over the
+    whole vehicles_data corpus against a FakeTransport."""
+    from columnar_cache import load_cache
+    from batching import payload_to_row
+    from trajectory import fix_to_payload
+
+    cache = load_cache()
+    rows = [payload_to_row(fix_to_payload(cache.fix(i))) for i in range(len(cache))]
+    transport = FakeTransport(append_latency, visibility_delay, fail_every)
+    writer = PositionsWriter(transport, backoff=0.001)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        submitted = time.monotonic()
+        expected = len(transport) + writer(rows[i:i + batch])
+        # wait until the batch is queryable
+        while len(transport.query()) < expected:
+            time.sleep(0.0005)
+        latencies.append(time.monotonic() - submitted)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rows": len(rows),
+        "rows_per_second": len(rows) / elapsed,
+        "latency_p50": latencies[len(latencies) // 2],
+        "latency_p99": latencies[int(len(latencies) * 0.99)],
+        **writer.stats(),
+    }
+
+
+if __name__ == "__main__":
+    print(benchmark_writer())
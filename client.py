@@ -1,13 +1,27 @@
-import enum
-from logging import exception
-from numpy import greater
-from coreiot_setter import create_device, create_registry, create_topic, create_subscription
-from google.cloud import iot_v1
-import time, json
-from google.api_core import exceptions
-from vehicle import get_client
-from dataflow import create_job_from_template
-from bigquery import create_dataset_and_table
+from vehicle import ConnectionManager, add_command_handlers
+from trajectory import open_cursors, fix_to_payload
+from replay import ReplayScheduler
+from batching import BatchingPublisher, JSON_ARRAY
+from codec import get_codec
+from provisioning import Step, Provisioner
+from spool import open_spool, SpoolForwarder
+from startup import lazy
+import client_registry
+import metrics
+
+# setters import the Google client libraries on their first call: when every
+# resource is known to exist (cached provisioning) none of them is imported
+create_topic = lazy("coreiot_setter", "create_topic")
+create_registry = lazy("coreiot_setter", "create_registry")
+create_subscription = lazy("coreiot_setter", "create_subscription")
+create_device = lazy("coreiot_setter", "create_device")
+create_dataset = lazy("bigquery", "create_dataset")
+create_table = lazy("bigquery", "create_table")
+create_latest_table = lazy("bigquery", "create_latest_table")
+create_latest_positions_schedule = lazy("bigquery", "create_latest_positions_schedule")
+create_job_from_template = lazy("dataflow", "create_job_from_template")
+# numpy, only needed by the opt-in preprocessing
+load_cache = lazy("columnar_cache", "load_cache")
 
 # setting variables
 device_id = 'vehicle001'
@@ -26,54 +40,58 @@ certificate_file = 'p_keys/RSA/rsa_public.pem'
 private_key_file = "p_keys/RSA/rsa_private.pem"
 bqCollection="vehicles_positions"
 bqOutputTable="positions"
+bqLatestTable="latest_positions"
 
-print("-------- Registry ---------")
-# create registry
-registry = create_registry(service_account_json, project_id, cloud_region, device_pubsub_topic, registry_id, only_mqtt)
-# excepts AlreadyExists errors
-if type(registry) == exceptions.AlreadyExists:
-    print(registry.message, "... going on with next step")
-
-print("-------- Topic ---------")
-# create topic
-topic = create_topic(service_account_json, project_id, device_pubsub_topic)
-# check if topic already exists
-if type(topic) == exceptions.AlreadyExists:
-    print("The topic {} already exists.... going on with next step".format(device_pubsub_topic))
-
-print("-------- Subscription ---")
-sub = create_subscription(service_account_json, project_id, device_pubsub_topic, subscription_id)
-# check if subscription already exists
-if type(sub) == exceptions.AlreadyExists:
-    print("The subscription {} already exists.... going on with next step".format(subscription_id))
-
-print("-------- Device ---------")
-# create device
-device = create_device(service_account_json, project_id, cloud_region, registry_id, device_id, certificate_file)
-# check if device already exists
-if type(device) == exceptions.AlreadyExists:
-    print("Device already exists... going on with next step")
-elif type(device) == exceptions.InvalidArgument:
-    print(device)
-elif type(device) == iot_v1.Device:
-    print("Device created: ", device_id)
-
-print("-------- BigQuery ---------")
-tab = create_dataset_and_table(service_account_json, project_id=project_id, dataset=bqCollection, table=bqOutputTable)
-if type(tab) == exceptions.Conflict:
-    print(f"Table {bqCollection}.{bqOutputTable} already exists .... going on with next step")
-
-
-print("-------- Dataflow Job ---------")
-# create dataflow job or check if it is running
-df = create_job_from_template(service_account_json, project_id, device_pubsub_topic, bqCollection, bqOutputTable )
-if type(df) == exceptions.AlreadyExists:
-    print(df.message, "... going on with client")
+# number of vehicle for data
+number_of_vehicles = 20
+vehicles = [a for a in range(1, number_of_vehicles + 1)]
+
+print("-------- Provisioning ---------")
+# resources as a dependency graph: independent steps run concurrently and
+# resources already known to exist (see .provisioning_state.json) are skipped
+project_path = f"projects/{project_id}"
+registry_path = f"{project_path}/locations/{cloud_region}/registries/{registry_id}"
+steps = [
+    Step("topic", lambda: create_topic(service_account_json, project_id, device_pubsub_topic),
+         key=f"{project_path}/topics/{device_pubsub_topic}"),
+    Step("registry", lambda: create_registry(service_account_json, project_id, cloud_region, device_pubsub_topic, registry_id, only_mqtt),
+         depends=["topic"], key=registry_path),
+    Step("subscription", lambda: create_subscription(service_account_json, project_id, device_pubsub_topic, subscription_id),
+         depends=["topic"], key=f"{project_path}/subscriptions/{subscription_id}"),
+    Step("device", lambda: create_device(service_account_json, project_id, cloud_region, registry_id, device_id, certificate_file, vehicles),
+         depends=["registry"], key=f"{registry_path}/devices/{device_id}"),
+    Step("dataset", lambda: create_dataset(service_account_json, project_id, bqCollection),
+         key=f"{project_id}.{bqCollection}"),
+    Step("table", lambda: create_table(service_account_json, project_id, bqCollection, bqOutputTable),
+         depends=["dataset"], key=f"{project_id}.{bqCollection}.{bqOutputTable}"),
+    Step("latest_table", lambda: create_latest_table(service_account_json, project_id, bqCollection, bqLatestTable),
+         depends=["dataset"], key=f"{project_id}.{bqCollection}.{bqLatestTable}"),
+    # scheduled MERGE of the newest fix of every vehicle into the latest table
+    Step("latest_schedule", lambda: create_latest_positions_schedule(service_account_json, project_id, bqCollection, bqOutputTable, bqLatestTable),
+         depends=["table", "latest_table"], key=f"{project_id}.{bqCollection}.{bqLatestTable}:schedule"),
+    # create dataflow job or check if it is running
+    Step("dataflow", lambda: create_job_from_template(service_account_json, project_id, device_pubsub_topic, bqCollection, bqOutputTable),
+         depends=["topic", "table"], key=f"{project_id}:{bqCollection}.{bqOutputTable}"),
+]
+Provisioner(steps).run()
+
+# Google API clients are shared by the setup steps above and no longer needed
+for name, usage in client_registry.stats().items():
+    print("Client {}: built in {:.3f}s, reused {} times ({:.3f}s saved)".format(
+        name, usage["construction_seconds"], usage["reuses"], usage["saved_seconds"]))
+client_registry.close()
 
 
 print("-------- Execution ---------")
-# create mqtt client
-client = get_client(
+# publish rate, publish-to-ack latency, queue depth, reconnects and JWT timings
+# on http://localhost:{metrics_port}/metrics (see metrics.py), None disables them
+metrics_port = None
+if metrics_port:
+    metrics.enable()
+    metrics.serve(metrics_port)
+
+# create mqtt connection (JWT refresh, reconnects and buffering while offline)
+client = ConnectionManager(
     project_id=project_id,
     cloud_region=cloud_region,
     registry_id=registry_id,
@@ -84,45 +102,83 @@ client = get_client(
     mqtt_bridge_hostname=mqtt_bridge_hostname,
     mqtt_bridge_port=mqtt_bridge_port
 )
+# commands for a vehicle arrive in its subfolder (see helpers/command_dispatcher.py)
+add_command_handlers(client.client, device_id, vehicles)
 
 # qos = 1 -> is fire and forget (client receives no acknoledge), on_publish is called also if the message isn't sent (loop not called)
 # qos = 1 means at least 1 (client receives an ack),
 # qos = 2 exactly one (slower)
 
-# number of vehicle for data
-number_of_vehicles = 20
-vehicles = [a for a in range(1, number_of_vehicles + 1)]
-
-# rows to read in the file 
+# first row to read in the files
 row = 1
 
+# replay speed: 1 is real time, 60 one minute of data per second, 0 as fast as possible
+replay_speedup = 60
+# idle gaps in the data longer than this (seconds) are shortened
+replay_max_gap = 600
+
+# message encoding of single fixes: "json", "struct" or "delta" (see codec.py)
+payload_codec = get_codec("json")
+
+# coalesce fixes per topic into one message (see batching.py). Binary codecs
+# and batches are only unpacked by helpers/subscriber.py --batched (the
+# BatchConsumer, with --sink bigquery to store them): the Dataflow
+# PubSub_to_BigQuery template only understands single JSON messages
+batch_fixes = False
+batch_format = JSON_ARRAY
+
+# drop duplicates and GPS jumps and thin dense bursts before publishing
+# (see preprocessing.py), e.g.
+#   from preprocessing import Preprocessor, GATE
+#   Preprocessor(max_speed=200.0, method=GATE, min_distance=100.0, max_interval=300)
+# drops about 20% of the fixes; None publishes every fix of the files
+preprocessor = None
+
+if preprocessor is not None:
+    streams = preprocessor.streams(load_cache(), vehicles, start_row=row)
+    preprocessor.report()
+else:
+    # one open cursor per vehicle, each fix is read only once from the file
+    streams = open_cursors(vehicles, start_row=row).values()
+
 # master topic where publish messages
 master_topic = '/devices/{}/events'.format(device_id)
 
-client.loop_start()
-while True:
-    data = []
-    for v in vehicles:
-        with open("vehicles_data/{}.txt".format(v)) as fp:
-            for i, line in enumerate(fp):
-                if i == row:
-                    data.append(line.strip())
-                    
-    for idx, data in enumerate(data):
-        splitted_data = str(data).split(",")
-        topic = master_topic + "/" + splitted_data[0].strip()
-        # data is like 17,2008-02-02 13:55:02,116.07255,38
-        payload = {
-            "vehicle": splitted_data[0],
-            "timestamp": splitted_data[1],
-            "lat": splitted_data[2],
-            "lon": splitted_data[3]
-        }
-        client.publish(topic, payload=json.dumps(payload).encode(encoding="UTF-8"), qos=0, retain=False)
-    time.sleep(20)
-    row = row + 1
-
-client.loop_stop()
-
-#client.loop_forever()
-
+# store and forward: messages are written to spool/{device_id} first and a
+# drain thread sends them with qos 1 at spool_rate per second while connected,
+# moving the spool cursor only past acknowledged messages, so nothing published
+# during an outage (or before a crash) is lost
+spool_fixes = True
+spool_rate = 1000.0
+
+spool = open_spool(device_id) if spool_fixes else None
+forwarder = SpoolForwarder(spool, client.try_publish, client.connected, rate=spool_rate).attach(client) if spool_fixes else None
+outbox = spool if spool_fixes else client
+
+batcher = BatchingPublisher(outbox, format=batch_format).start() if batch_fixes else None
+
+def publish_fix(fix):
+    topic = master_topic + "/" + str(fix.vehicle)
+    # data is like 17,2008-02-02 13:55:02,116.07255,39.85001 (id,timestamp,lon,lat)
+    if batcher is not None:
+        batcher.publish(topic, fix_to_payload(fix))
+        return
+    outbox.publish(topic, payload=payload_codec.encode([fix]), qos=0, retain=False)
+
+# publish every fix at its recorded time, all vehicles merged by timestamp
+scheduler = ReplayScheduler(streams, speedup=replay_speedup, max_gap=replay_max_gap)
+
+client.start()
+if forwarder is not None:
+    forwarder.start()
+scheduler.run(publish_fix)
+scheduler.report()
+if batcher is not None:
+    batcher.close()
+    print("Batching:", batcher.stats())
+if forwarder is not None:
+    forwarder.stop()
+    forwarder.report()
+    spool.close()
+client.stop()
+print("Connection:", client.stats())
@@ -0,0 +1,177 @@
+# imports
+import json, struct, time
+from trajectory import Fix, fix_to_payload
+from replay import fix_epoch
+
+# first byte of a binary message, tells the decoder which codec wrote it.
+# JSON messages start with '{' or '[' and 0x01 is a batching.BINARY batch
+STRUCT_MARKER = 0x02
+DELTA_MARKER = 0x03
+
+# coordinates travel as integer micro-degrees (the data has 5 decimals)
+coordinate_scale = 1000000
+
+
+def _to_micro(degrees):
+    return int(round(degrees * coordinate_scale))
+
+
+def _timestamp(epoch):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def payload_to_fix(payload):
+    """Fix of a decoded JSON payload (see trajectory.fix_to_payload)."""
+    return Fix(int(payload["vehicle"]), payload["timestamp"], float(payload["lon"]), float(payload["lat"]))
+
+
+class JsonCodec:
+    """The original format: one JSON object per fix (an array for many)."""
+
+    name = "json"
+    marker = None
+
+    def encode(self, fixes):
+        payloads = [fix_to_payload(f) for f in fixes]
+        body = payloads[0] if len(payloads) == 1 else payloads
+        return json.dumps(body, separators=(",", ":")).encode(encoding="UTF-8")
+
+    def decode(self, data):
+        decoded = json.loads(data)
+        if not isinstance(decoded, list):
+            decoded = [decoded]
+        return [payload_to_fix(p) for p in decoded]
+
+
+class StructCodec:
+    """Fixed-width records: marker byte, then per fix a big-endian int32
+    vehicle, int64 epoch seconds and int32 micro-degrees lon and lat
+    (20 bytes per fix instead of ~90 of JSON)."""
+
+    name = "struct"
+    marker = STRUCT_MARKER
+    record = struct.Struct(">iqii")
+
+    def encode(self, fixes):
+        pack = self.record.pack
+        return bytes([self.marker]) + b"".join(
+            pack(f.vehicle, int(fix_epoch(f)), _to_micro(f.lon), _to_micro(f.lat)) for f in fixes)
+
+    def decode(self, data):
+        return [Fix(vehicle, _timestamp(epoch), lon / coordinate_scale, lat / coordinate_scale)
+                for vehicle, epoch, lon, lat in self.record.iter_unpack(memoryview(data)[1:])]
+
+
+def _write_varint(out, value):
+    # zigzag, so small negative deltas stay short
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, i):
+    shift = 0
+    result = 0
+    while True:
+        byte = data[i]
+        i += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), i
+
+
+class DeltaCodec:
+    """Delta-encoded fixes: marker byte, then for each fix the difference of
+    vehicle, epoch seconds and micro-degree lon/lat from the previous fix of
+    the message, as zigzag varints. The first fix is relative to zero, so every
+    message decodes on its own (no state is lost with a dropped message).
+    Consecutive fixes of one vehicle, as a batched topic carries, shrink to a
+    few bytes each."""
+
+    name = "delta"
+    marker = DELTA_MARKER
+
+    def encode(self, fixes):
+        out = bytearray([self.marker])
+        previous = (0, 0, 0, 0)
+        for f in fixes:
+            current = (f.vehicle, int(fix_epoch(f)), _to_micro(f.lon), _to_micro(f.lat))
+            for value, last in zip(current, previous):
+                _write_varint(out, value - last)
+            previous = current
+        return bytes(out)
+
+    def decode(self, data):
+        fixes = []
+        vehicle = epoch = lon = lat = 0
+        i = 1
+        while i < len(data):
+            d, i = _read_varint(data, i)
+            vehicle += d
+            d, i = _read_varint(data, i)
+            epoch += d
+            d, i = _read_varint(data, i)
+            lon += d
+            d, i = _read_varint(data, i)
+            lat += d
+            fixes.append(Fix(vehicle, _timestamp(epoch), lon / coordinate_scale, lat / coordinate_scale))
+        return fixes
+
+
+# available codecs by name
+codecs = {c.name: c for c in (JsonCodec(), StructCodec(), DeltaCodec())}
+_by_marker = {c.marker: c for c in codecs.values() if c.marker is not None}
+
+
+def get_codec(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Unknown codec {}, available: {}".format(name, ", ".join(codecs)))
+
+
+def decode_fixes(data):
+    """Decode a message body written by any codec into a list of Fix."""
+    codec = _by_marker.get(data[0]) if data else None
+    return (codec or codecs["json"]).decode(data)
+
+
+def benchmark_codecs(batch=20):
+    """Encode/decode ns per fix and payload bytes per fix of every codec over
+    the vehicles_data corpus, one fix per message and in batches of `batch`
+    consecutive fixes of a vehicle."""
+    from columnar_cache import load_cache
+
+    cache = load_cache()
+    fixes = [cache.fix(i) for i in range(len(cache))]
+    # consecutive fixes of one vehicle, as a per-topic batch carries them
+    groups = []
+    for v in cache.vehicles:
+        rows = cache.rows(int(v))
+        groups += [fixes[i:min(i + batch, rows.stop)] for i in range(rows.start, rows.stop, batch)]
+
+    results = {}
+    for name, codec in codecs.items():
+        for label, messages in (("single", [[f] for f in fixes]), ("batch", groups)):
+            start = time.perf_counter()
+            bodies = [codec.encode(m) for m in messages]
+            encoded = time.perf_counter()
+            for body in bodies:
+                codec.decode(body)
+            decoded = time.perf_counter()
+            results["{}/{}".format(name, label)] = {
+                "encode_ns": (encoded - start) * 1e9 / len(fixes),
+                "decode_ns": (decoded - encoded) * 1e9 / len(fixes),
+                "bytes_per_fix": sum(len(b) for b in bodies) / len(fixes),
+            }
+    return results
+
+
+if __name__ == "__main__":
+    for key, r in benchmark_codecs().items():
+        print("{:14} encode {:7.0f} ns/fix  decode {:7.0f} ns/fix  {:6.1f} bytes/fix".format(
+            key, r["encode_ns"], r["decode_ns"], r["bytes_per_fix"]))
@@ -0,0 +1,136 @@
+# imports
+import os, json, glob
+import numpy as np
+from trajectory import Fix, data_dir
+
+# folder where the binary columns are stored
+cache_dir = "vehicles_cache"
+
+# bump when the on-disk layout changes, older caches are rebuilt
+cache_version = 1
+
+# column name -> dtype, one raw little-endian file per column
+columns = {
+    "vehicle": np.dtype("<i4"),
+    "timestamp": np.dtype("<i8"),
+    "lon": np.dtype("<f8"),
+    "lat": np.dtype("<f8"),
+}
+
+
+def _source_files(folder):
+    """vehicles_data files sorted by vehicle id."""
+    files = glob.glob(os.path.join(folder, "*.txt"))
+    return sorted(files, key=lambda p: int(os.path.splitext(os.path.basename(p))[0]))
+
+
+def _source_mtimes(folder):
+    return {os.path.basename(p): os.stat(p).st_mtime_ns for p in _source_files(folder)}
+
+
+def _parse_file(path):
+    """Parse a whole trajectory file into column arrays."""
+    with open(path, "rb") as f:
+        rows = [line.split(b",") for line in f.read().splitlines() if line.strip()]
+    vehicle = np.array([int(r[0]) for r in rows], dtype=columns["vehicle"])
+    # T-Drive timestamps have no zone, they are stored as-is in epoch seconds
+    timestamp = np.array([r[1].strip().decode("UTF-8") for r in rows], dtype="datetime64[s]").astype(columns["timestamp"])
+    lon = np.array([float(r[2]) for r in rows], dtype=columns["lon"])
+    lat = np.array([float(r[3]) for r in rows], dtype=columns["lat"])
+    return {"vehicle": vehicle, "timestamp": timestamp, "lon": lon, "lat": lat}
+
+
+def _column_path(target, name):
+    return os.path.join(target, "{}.bin".format(name))
+
+
+def build_cache(folder=data_dir, target=cache_dir):
+    """Convert every vehicles_data file into the binary columnar store.
+
+    Writes one file per column, the sorted vehicle ids, an offsets table
+    (rows of vehicles[i] are offsets[i]:offsets[i + 1]) and a manifest with
+    the mtime of every source file. The manifest is written last, so an
+    interrupted build is never mistaken for a valid cache.
+    """
+    os.makedirs(target, exist_ok=True)
+    manifest_path = os.path.join(target, "manifest.json")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    mtimes = _source_mtimes(folder)
+    parts = [_parse_file(os.path.join(folder, name)) for name in mtimes]
+
+    vehicles = np.array([int(os.path.splitext(name)[0]) for name in mtimes], dtype=np.int32)
+    offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p["vehicle"]) for p in parts])
+
+    for name, dtype in columns.items():
+        data = np.concatenate([p[name] for p in parts]) if parts else np.empty(0, dtype=dtype)
+        data.astype(dtype, copy=False).tofile(_column_path(target, name))
+    vehicles.tofile(_column_path(target, "vehicles"))
+    offsets.tofile(_column_path(target, "offsets"))
+
+    with open(manifest_path, "w") as f:
+        json.dump({"version": cache_version, "rows": int(offsets[-1]), "sources": mtimes}, f)
+    print("Columnar cache: {} rows of {} vehicles written in {}".format(int(offsets[-1]), len(vehicles), target))
+
+
+def cache_is_fresh(folder=data_dir, target=cache_dir):
+    """True if the cache exists and no source file was added, removed or modified."""
+    try:
+        with open(os.path.join(target, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return manifest.get("version") == cache_version and manifest.get("sources") == _source_mtimes(folder)
+
+
+class FleetCache:
+    """Read-only, memory-mapped view of the columnar store.
+
+    Columns are numpy.memmap arrays, so slicing a vehicle trajectory does not
+    copy or parse anything: pages are loaded by the OS when touched.
+    """
+
+    def __init__(self, target=cache_dir):
+        self.vehicles = np.fromfile(_column_path(target, "vehicles"), dtype=np.int32)
+        self.offsets = np.fromfile(_column_path(target, "offsets"), dtype=np.int64)
+        rows = int(self.offsets[-1])
+        for name, dtype in columns.items():
+            if rows:
+                data = np.memmap(_column_path(target, name), dtype=dtype, mode="r", shape=(rows,))
+            else:
+                # numpy can not map an empty file
+                data = np.empty(0, dtype=dtype)
+            setattr(self, name, data)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def rows(self, vehicle):
+        """Slice of the rows belonging to a vehicle."""
+        i = int(np.searchsorted(self.vehicles, vehicle))
+        if i == len(self.vehicles) or self.vehicles[i] != vehicle:
+            raise KeyError(vehicle)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def trajectory(self, vehicle):
+        """(timestamp, lon, lat) zero-copy views of a vehicle trajectory."""
+        s = self.rows(vehicle)
+        return self.timestamp[s], self.lon[s], self.lat[s]
+
+    def fix(self, i):
+        """Row i as a trajectory.Fix."""
+        timestamp = str(np.datetime64(int(self.timestamp[i]), "s")).replace("T", " ")
+        return Fix(int(self.vehicle[i]), timestamp, float(self.lon[i]), float(self.lat[i]))
+
+
+def load_cache(folder=data_dir, target=cache_dir):
+    """Open the columnar cache, rebuilding it first if the sources changed."""
+    if not cache_is_fresh(folder, target):
+        build_cache(folder, target)
+    return FleetCache(target)
+
+
+if __name__ == "__main__":
+    build_cache()
@@ -1,6 +1,7 @@
 from google.cloud import iot_v1, pubsub_v1, pubsub
 import io
 from google.api_core import exceptions
+from client_registry import shared_client
 
 # function to create a device registry
 def create_registry(service_account_json, project_id, cloud_region, pubsub_topic, registry_id, only_mqtt ):
@@ -8,7 +9,7 @@ def create_registry(service_account_json, project_id, cloud_region, pubsub_topic
     the registry already exists."""
 
     # create a device manager client from service account
-    client = iot_v1.DeviceManagerClient.from_service_account_json(service_account_json)
+    client = shared_client(iot_v1.DeviceManagerClient, service_account_json)
 
     # parent url of the project
     parent = f"projects/{project_id}/locations/{cloud_region}"
@@ -41,7 +42,7 @@ def create_registry(service_account_json, project_id, cloud_region, pubsub_topic
 # function to create a pub/sub topic
 def create_topic(service_account_json, project_id, topic_id):
     # create PublisherClient
-    publisher = pubsub_v1.PublisherClient.from_service_account_file(service_account_json)
+    publisher = shared_client(pubsub_v1.PublisherClient, service_account_json)
 
 
     topic_path = publisher.topic_path(project_id, topic_id)
@@ -56,9 +57,9 @@ def create_topic(service_account_json, project_id, topic_id):
 
 def create_subscription(service_account_json, project_id, topic_id, subscription_id):
 
-    publisher = pubsub_v1.PublisherClient.from_service_account_file(service_account_json)
-    subscriber = pubsub_v1.SubscriberClient.from_service_account_file(service_account_json)
-    topic_path = publisher.topic_path(project_id, topic_id)
+    subscriber = shared_client(pubsub_v1.SubscriberClient, service_account_json)
+    # path helpers are static, no publisher client is needed to format the topic
+    topic_path = pubsub_v1.PublisherClient.topic_path(project_id, topic_id)
     subscription_path = subscriber.subscription_path(project_id, subscription_id)
 
     try:
@@ -72,9 +73,9 @@ def create_subscription(service_account_json, project_id, topic_id, subscription
 
 
 
-def create_device(service_account_json, project_id, cloud_region, registry_id, device_id, certificate_file):
+def create_device(service_account_json, project_id, cloud_region, registry_id, device_id, certificate_file, vehicles=None):
     # create an istance of DeviceManagerClient
-    client = iot_v1.DeviceManagerClient.from_service_account_json(service_account_json)
+    client = shared_client(iot_v1.DeviceManagerClient, service_account_json)
     # create parent url
     parent = f"projects/{project_id}/locations/{cloud_region}/registries/{registry_id}"
     # read the public key
@@ -92,6 +93,9 @@ def create_device(service_account_json, project_id, cloud_region, registry_id, d
             }
         ],
     }
+    # vehicles simulated by the device, read back by command_dispatcher.load_routes
+    if vehicles:
+        device_template["metadata"] = {"vehicles": ",".join(str(v) for v in vehicles)}
     try:    
         dev = client.create_device(request={"parent": parent, "device": device_template})    
         print("Device {} created....".format(dev.id))
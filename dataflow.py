@@ -1,8 +1,9 @@
 from google.cloud import dataflow_v1beta3
+from client_registry import shared_client
 
 def create_job_from_template(service_account_file, project_id, inputTopic, bqCollection, bqOutputTable):
     # Create a TemplateServiceClient to create dataflow jobs from templates
-    client = dataflow_v1beta3.TemplatesServiceClient.from_service_account_file(service_account_file)
+    client = shared_client(dataflow_v1beta3.TemplatesServiceClient, service_account_file)
     # define a runtime for the job/worker
     runtime = dataflow_v1beta3.RuntimeEnvironment(
             num_workers=1,
@@ -1,19 +1,43 @@
 
 
-from google.cloud import iot_v1, bigquery
-from math import sqrt, inf
+import os, threading, time, uuid
+from collections import deque
+# Google client libraries and the numpy based modules (spatial_index,
+# fleet_state, dispatch) are imported by the functions using them, so the
+# cold start only pays for the ones the request needs
+# (see startup.py: python startup.py helpers/cloud_function.py)
+_import_started = time.perf_counter()
 
+from client_registry import shared_client
+from command_dispatcher import CommandDispatcher, load_routes
 
-def send_command_to_device(service_account_json, project_id, registry_location, registry_id, deviceID, command):
-    
-    # Create a client
-    client = iot_v1.DeviceManagerClient.from_service_account_file(service_account_json)
+# latest positions, kept across the invocations of a warm instance
+fleet = None
+# subscription feeding them, created on cold start
+fleet_subscription = None
+# command dispatcher, routes loaded on cold start
+dispatcher = None
+# concurrent requests of a cold instance build fleet and dispatcher once
+_fleet_lock = threading.Lock()
+_dispatcher_lock = threading.Lock()
+# latency of the first invocation of the instance and of the last 1000 following ones
+invocations = {"cold": [], "warm": deque(maxlen=1000)}
+
+
+def send_command_to_device(service_account_json, project_id, registry_location, registry_id, deviceID, command, subfolder=None):
+    from google.cloud import iot_v1
+
+    # shared client, built on the first call of the instance
+    client = shared_client(iot_v1.DeviceManagerClient, service_account_json)
 
     # Initialize request argument(s)
     request = iot_v1.SendCommandToDeviceRequest(
         name=f"projects/{project_id}/locations/{registry_location}/registries/{registry_id}/devices/{deviceID}",
         binary_data=bytes(command,'UTF-8')
     )
+    # the device receives it on /devices/{deviceID}/commands/{subfolder}
+    if subfolder:
+        request.subfolder = str(subfolder)
     
     # Make the request
     response = client.send_command_to_device(request=request)
@@ -25,35 +49,93 @@ def send_command_to_device(service_account_json, project_id, registry_location,
     else:
         return 500
 
-def query_bq(service_account_json):
+# latest position of every vehicle, from the table kept by the scheduled
+# query of bigquery.create_latest_positions_schedule (one row per vehicle,
+# clustered, up to 5 minutes behind; the subscription does the rest): the scan
+# does not grow with the positions table. Vehicles silent for more than
+# @window_hours before the newest fix are left out
+latest_positions_query = """
+    SELECT vehicle, timestamp, lat, lon FROM `pccreverselogistic.vehicles_positions.latest_positions`
+    WHERE timestamp >= TIMESTAMP_SUB(
+        (SELECT max(timestamp) FROM `pccreverselogistic.vehicles_positions.latest_positions`),
+        INTERVAL @window_hours HOUR
+    ) ORDER BY vehicle
+"""
 
-    client = bigquery.Client.from_service_account_json(service_account_json)
+def query_bq(service_account_json, window_hours=24):
+    from google.cloud import bigquery
 
-    query = """
-        SELECT DISTINCT t1.vehicle, t1.timestamp, t1.lat, t1.lon FROM `pccreverselogistic.vehicles_positions.positions` AS t1
-        WHERE t1.timestamp = (
-            SELECT max(timestamp) FROM `pccreverselogistic.vehicles_positions.positions` AS t2
-        WHERE t2.vehicle = t1.vehicle
-        ) ORDER BY t1.vehicle
-    """
+    client = shared_client(bigquery.Client, service_account_json)
 
-    res = client.query(query=query)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("window_hours", "INT64", window_hours)]
+    )
+    res = client.query(query=latest_positions_query, job_config=job_config)
     return res
-            
-def get_nearest_vehicle(res, return_point_lat, return_point_lon):
 
-    nearest_vechicle = 0
-    smaller_distance = inf
-    
-    for row in res:
+def create_instance_subscription(service_account_json, project_id, topic_id):
+    """Subscription of this instance only, on the positions topic.
 
-        distance = sqrt(((row.lat - return_point_lat)**2) + ((row.lon - return_point_lon)**2))
+    Pub/Sub hands each message of a subscription to one consumer: sharing
+    one with helpers/subscriber.py or with the other instances would leave
+    every FleetState with part of the stream. It is deleted by Pub/Sub a day
+    after its instance stops pulling (expiration policy) and keeps at most
+    10 minutes of backlog, the BigQuery warm-up covers the rest."""
+    from google.cloud import pubsub_v1
 
-        if (distance <= smaller_distance):
-            smaller_distance = distance
-            nearest_vechicle = row.vehicle
-    
-    return nearest_vechicle
+    subscriber = shared_client(pubsub_v1.SubscriberClient, service_account_json)
+    subscription_path = subscriber.subscription_path(
+        project_id, "{}-{}".format(fleet_subscription_prefix, uuid.uuid4().hex[:12]))
+    subscriber.create_subscription(request={
+        "name": subscription_path,
+        "topic": pubsub_v1.PublisherClient.topic_path(project_id, topic_id),
+        "ack_deadline_seconds": 10,
+        "message_retention_duration": {"seconds": 600},
+        "expiration_policy": {"ttl": {"seconds": 24 * 3600}},
+    })
+    print("Subscription {} created".format(subscription_path))
+    return subscription_path
+
+def get_fleet_state(service_account_json, project_id, topic_id):
+    """Fleet state of this instance. On cold start it is warmed up from
+    BigQuery and then kept current by a subscription of its own."""
+    global fleet, fleet_subscription
+
+    if fleet is not None:
+        return fleet
+
+    with _fleet_lock:
+        # another request may have built it meanwhile
+        if fleet is not None:
+            return fleet
+        from google.cloud import pubsub_v1
+        from fleet_state import FleetState
+
+        if fleet_subscription is None:
+            fleet_subscription = create_instance_subscription(service_account_json, project_id, topic_id)
+        state = FleetState()
+        subscriber = shared_client(pubsub_v1.SubscriberClient, service_account_json)
+        pull = state.subscribe(subscriber, fleet_subscription)
+        try:
+            # stale rows can not override newer fixes, so warming up after subscribing is safe
+            state.warm_up(query_bq(service_account_json))
+        except Exception:
+            pull.cancel()
+            raise
+        # kept only once complete: after a failure the next call builds it again
+        fleet = state
+        return fleet
+
+def get_nearest_vehicle(res, return_point_lat, return_point_lon):
+    from spatial_index import SpatialIndex
+
+    # index the latest positions and rank them by haversine distance
+    index = SpatialIndex.from_rows(res)
+    nearest = index.nearest(return_point_lat, return_point_lon)
+
+    if not nearest:
+        return 0
+    return nearest[0][0]
 
 
 # environment variables
@@ -62,27 +144,162 @@ project_id = "pccreverselogistic"
 registry_location = "europe-west1"
 registry_id = "vehicles"
 deviceID = "vehicle001"
+device_pubsub_topic = "vehicle_position"
+# every instance reads the positions through its own subscription, fleet-state-{id}
+fleet_subscription_prefix = "fleet-state"
+# commands sent at the same time by dispatch_batch, and per second
+command_parallelism = 8
+command_rate = 50.0
+
+# return command sent to a vehicle
+command_template = "Vehicle {vehicle} new return to do at location: latitude {lat} - longitude {lon}"
+
+def precompute():
+    """Build the instance state before the first request: the Google clients
+    (credentials parsed, channels opened), the fleet state warmed up from
+    BigQuery and its spatial index, and the command routes."""
+    start = time.perf_counter()
+    get_fleet_state(service_account_json, project_id, device_pubsub_topic)
+    get_dispatcher()
+    print("Instance state built in {:.3f}s".format(time.perf_counter() - start))
+
+def get_dispatcher():
+    """Command dispatcher of this instance, routing every vehicle to the
+    device simulating it (devices metadata, see coreiot_setter.create_device)."""
+    global dispatcher
+
+    if dispatcher is not None:
+        return dispatcher
+
+    with _dispatcher_lock:
+        # another request may have built it meanwhile
+        if dispatcher is not None:
+            return dispatcher
+        from google.cloud import iot_v1
+
+        client = shared_client(iot_v1.DeviceManagerClient, service_account_json)
+        routes = load_routes(client, client.registry_path(project_id, registry_location, registry_id))
+        dispatcher = CommandDispatcher(
+            lambda device, vehicle, command: send_command_to_device(
+                service_account_json, project_id, registry_location, registry_id, device, command, subfolder=vehicle),
+            routes, default_device=deviceID, parallelism=command_parallelism, rate=command_rate)
+        return dispatcher
+
+def parse_batch(request_json):
+    """(points, method) of a dispatch_batch body, ValueError when malformed."""
+    from dispatch import GREEDY, HUNGARIAN
+
+    if not isinstance(request_json, dict):
+        raise ValueError("The body must be a JSON object")
+    method = request_json.get("method", GREEDY)
+    if method not in (GREEDY, HUNGARIAN):
+        raise ValueError("Unknown method {!r}, use {!r} or {!r}".format(method, GREEDY, HUNGARIAN))
+    raw = request_json.get("return_points", [])
+    if not isinstance(raw, list):
+        raise ValueError("return_points must be a list")
+    points = []
+    for i, p in enumerate(raw):
+        try:
+            lat, lon = float(p["lat"]), float(p["lon"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("return_points[{}] needs numeric lat and lon".format(i))
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            raise ValueError("return_points[{}] is out of range".format(i))
+        points.append((lat, lon))
+    return points, method
+
+def dispatch_batch(request):
+    """HTTP entry point: assign many return points in one call.
+
+    Body: {"return_points": [{"lat": 39.9, "lon": 116.4}, ...], "method": "greedy"}
+    Every point gets a different vehicle (greedy closest-first or hungarian)
+    from one distance matrix over the fleet state, then the commands are sent
+    concurrently to the device of each vehicle, at most command_parallelism
+    at a time and command_rate per second, transient errors retried.
+    A malformed body, an unknown method or the hungarian method without
+    scipy installed (it is optional, see helpers/dispatch.py) get a 400.
+    """
+    from dispatch import assign
+
+    start = time.perf_counter()
+    cold = not (invocations["cold"] or invocations["warm"])
+    try:
+        points, method = parse_batch(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    state = get_fleet_state(service_account_json, project_id, device_pubsub_topic)
+    try:
+        assignment = assign(state.positions(), points, method)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    commands = [
+        (vehicle, command_template.format(vehicle=vehicle, lat=lat, lon=lon))
+        for (lat, lon), (vehicle, _) in zip(points, assignment) if vehicle is not None
+    ]
+    statuses = [s if isinstance(s, int) else 500 for s in get_dispatcher().dispatch_all(commands)]
+
+    elapsed = time.perf_counter() - start
+    invocations["cold" if cold else "warm"].append(elapsed)
+    print("{} invocation in {:.3f}s".format("Cold" if cold else "Warm", elapsed))
+    results = [
+        {"lat": lat, "lon": lon, "vehicle": vehicle, "distance_km": distance}
+        for (lat, lon), (vehicle, distance) in zip(points, assignment)
+    ]
+    assigned = len(commands)
+    return {
+        "assignments": results,
+        "statuses": statuses,
+        "seconds": elapsed,
+        "assignments_per_second": assigned / elapsed if elapsed else 0.0,
+        "commands": dispatcher.stats(),
+        "cold_start": cold,
+        "import_seconds": import_seconds,
+    }
+
+
+def invocation_stats():
+    """Cold and warm invocation latencies of this instance, reported apart:
+    a cold one includes building the instance state."""
+    return {
+        kind: {"count": len(l), "mean_seconds": sum(l) / len(l) if l else 0.0, "max_seconds": max(l, default=0.0)}
+        for kind, l in invocations.items()
+    }
 
-# # cast data from request
-# request_json = request.get_json(silent=True)
 
-# get latitude and longitude
-return_point_lat = 119.000
-return_point_lon = 39.000
+# time spent importing this module (the cold start before any request)
+import_seconds = time.perf_counter() - _import_started
 
-# get data drom bigquery
-data = query_bq(service_account_json)
-# get nearest vehicle
-vehicle = get_nearest_vehicle(data, return_point_lat, return_point_lon)
+# deployed (Cloud Functions / Cloud Run set K_SERVICE): build the state while
+# the instance starts, not in the first request. Locally importing stays cheap
+if os.environ.get("K_SERVICE") and os.environ.get("PRECOMPUTE_ON_START", "1") == "1":
+    try:
+        precompute()
+    except Exception as e:
+        # a failing import would crash-loop the instance: the first request
+        # builds what is missing (get_fleet_state, get_dispatcher) and fails alone
+        print("Instance state not built on start, deferred to the first request: {!r}".format(e))
 
-# create command 
-command = f"Vehicle {vehicle} new return to do at location: latitude {return_point_lat} - longitude {return_point_lon}"
 
-print("Trying to send command: ", command)
+if __name__ == "__main__":
+    # # cast data from request
+    # request_json = request.get_json(silent=True)
 
-# send message to vehicle
-status = send_command_to_device(service_account_json, project_id, registry_location, registry_id, deviceID, command)
+    # get latitude and longitude
+    return_point_lat = 39.000
+    return_point_lon = 119.000
 
+    # latest positions (BigQuery is queried only on cold start)
+    state = get_fleet_state(service_account_json, project_id, device_pubsub_topic)
+    # get nearest vehicle, straight from the spatial index of the fleet state
+    nearest = state.nearest(return_point_lat, return_point_lon)
+    vehicle = nearest[0][0] if nearest else 0
 
+    # create command 
+    command = command_template.format(vehicle=vehicle, lat=return_point_lat, lon=return_point_lon)
 
+    print("Trying to send command: ", command)
 
+    # send message to the device of the vehicle
+    status = get_dispatcher().dispatch(vehicle, command).result()
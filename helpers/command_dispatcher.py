@@ -0,0 +1,141 @@
+# imports
+import functools, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors():
+    """Errors worth sending a command again for. google.api_core is imported
+    on the first send, not with the cloud function."""
+    from google.api_core import exceptions
+
+    return (
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.ResourceExhausted,
+        exceptions.InternalServerError,
+    )
+
+
+def load_routes(client, registry_path):
+    """vehicle -> device id, from the "vehicles" metadata of the registry devices
+    (a comma separated list, see coreiot_setter.create_device)."""
+    routes = {}
+    devices = client.list_devices(request={"parent": registry_path, "field_mask": "metadata"})
+    for device in devices:
+        for vehicle in device.metadata.get("vehicles", "").split(","):
+            if vehicle.strip():
+                routes[int(vehicle)] = device.id
+    return routes
+
+
+class RateLimiter:
+    """At most `rate` acquisitions per second, shared by many threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CommandDispatcher:
+    """Send commands to the devices owning the vehicles, concurrently.
+
+    Every command is routed to the device that simulates the vehicle (routes,
+    falling back to default_device) and sent in the vehicle's subfolder, so
+    the device gets it on /devices/{device}/commands/{vehicle}. Sends run on
+    a pool of `parallelism` threads, at most `rate` per second, and transient
+    errors are retried with exponential backoff. The latency of the last
+    `window` delivered commands (queueing included) is kept for stats().
+
+    Args:
+     send: callable send(device_id, vehicle, command) doing one RPC
+     routes: dict vehicle -> device id
+     default_device: device of the vehicles missing from routes
+    """
+
+    def __init__(self, send, routes, default_device=None, parallelism=8, rate=50.0, retries=3, backoff=0.5, window=1000):
+        self.send = send
+        self.routes = routes
+        self.default_device = default_device
+        self.retries = retries
+        self.backoff = backoff
+        self._limiter = RateLimiter(rate)
+        self._pool = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="command")
+        self._lock = threading.Lock()
+        # bounded: a warm instance lives for many invocations
+        self.latencies = deque(maxlen=window)
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+
+    def device_of(self, vehicle):
+        return self.routes.get(vehicle, self.default_device)
+
+    def dispatch(self, vehicle, command):
+        """Queue a command, returns a future of the send result."""
+        return self._pool.submit(self._deliver, vehicle, command, time.monotonic())
+
+    def dispatch_all(self, commands):
+        """Send (vehicle, command) pairs, returns the results in order
+        (the exception instead of the result for failed commands)."""
+        futures = [self.dispatch(vehicle, command) for vehicle, command in commands]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _deliver(self, vehicle, command, queued):
+        device = self.device_of(vehicle)
+        if device is None:
+            raise ValueError("No device owns vehicle {}".format(vehicle))
+        retryable = retryable_errors()
+        for attempt in range(self.retries + 1):
+            self._limiter.acquire()
+            try:
+                result = self.send(device, vehicle, command)
+                break
+            except retryable:
+                if attempt == self.retries:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+        with self._lock:
+            self.latencies.append(time.monotonic() - queued)
+            self.delivered += 1
+        return result
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            return {
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "retried": self.retried,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+                "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            }
+
+    def close(self):
+        self._pool.shutdown(wait=True)
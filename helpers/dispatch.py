@@ -0,0 +1,70 @@
+# imports
+import numpy as np
+from spatial_index import haversine
+
+# assignment methods
+GREEDY = "greedy"
+HUNGARIAN = "hungarian"
+
+
+def distance_matrix(points_lat, points_lon, vehicles_lat, vehicles_lon):
+    """(points x vehicles) haversine distances in km, in one vectorized pass."""
+    points_lat = np.asarray(points_lat, dtype=float)
+    points_lon = np.asarray(points_lon, dtype=float)
+    return haversine(points_lat[:, None], points_lon[:, None],
+                     np.asarray(vehicles_lat, dtype=float)[None, :], np.asarray(vehicles_lon, dtype=float)[None, :])
+
+
+def _greedy(d):
+    # closest (point, vehicle) pairs first, skipping used points and vehicles
+    rows, cols = np.unravel_index(np.argsort(d, axis=None, kind="stable"), d.shape)
+    used_points = np.zeros(d.shape[0], dtype=bool)
+    used_vehicles = np.zeros(d.shape[1], dtype=bool)
+    pairs = []
+    for r, c in zip(rows.tolist(), cols.tolist()):
+        if used_points[r] or used_vehicles[c]:
+            continue
+        used_points[r] = used_vehicles[c] = True
+        pairs.append((r, c))
+        if len(pairs) == min(d.shape):
+            break
+    return pairs
+
+
+def _hungarian(d):
+    # optimal total distance, scipy is only needed for this method
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        raise ValueError("The hungarian method needs scipy, use greedy instead")
+    rows, cols = linear_sum_assignment(d)
+    return list(zip(rows.tolist(), cols.tolist()))
+
+
+def assign(positions, points, method=GREEDY):
+    """Assign return points to vehicles, each vehicle at most once.
+
+    Args:
+     positions: latest positions, rows with vehicle, lat and lon attributes
+     points: list of (lat, lon) return points
+     method: GREEDY (closest pairs first) or HUNGARIAN (minimum total distance)
+    Returns:
+        A list with, for every point, (vehicle, distance km), or (None, None)
+        when there are more points than vehicles.
+    """
+    positions = list(positions)
+    assignment = [(None, None)] * len(points)
+    if not positions or not points:
+        return assignment
+    vehicles = [p.vehicle for p in positions]
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    d = distance_matrix(points[:, 0], points[:, 1], [p.lat for p in positions], [p.lon for p in positions])
+    if method == GREEDY:
+        pairs = _greedy(d)
+    elif method == HUNGARIAN:
+        pairs = _hungarian(d)
+    else:
+        raise ValueError("Unknown assignment method {}".format(method))
+    for r, c in pairs:
+        assignment[r] = (vehicles[c], float(d[r, c]))
+    return assignment
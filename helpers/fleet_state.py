@@ -0,0 +1,97 @@
+# imports
+import threading
+import datetime
+from collections import namedtuple
+import numpy as np
+from spatial_index import SpatialIndex
+
+from batching import decode_payload
+
+# same fields as the rows of cloud_function.query_bq
+Position = namedtuple("Position", ["vehicle", "timestamp", "lat", "lon"])
+
+
+def _epoch(timestamp):
+    """Epoch seconds of a payload timestamp string or a BigQuery datetime."""
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.timestamp()
+
+
+class FleetState:
+    """Latest fix of every vehicle, kept in memory from the Pub/Sub stream.
+
+    Positions are stored in the SpatialIndex arrays (one slot per vehicle),
+    with the fix time in a parallel array: a lookup is an array read and
+    nearest-vehicle queries use the grid directly, instead of a BigQuery
+    max(timestamp) scan per request. A fix only replaces the stored one if it
+    is newer, so duplicated and out-of-order deliveries are harmless.
+
+    Pub/Sub hands each message of a subscription to one consumer only: if
+    other consumers read the same subscription, give the FleetState its own.
+    """
+
+    def __init__(self):
+        self.index = SpatialIndex()
+        self.epoch = np.full(len(self.index.vehicles), -np.inf)
+        self._lock = threading.Lock()
+        # fixes applied and fixes ignored as stale or duplicated
+        self.applied = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def update(self, vehicle, timestamp, lat, lon):
+        """Apply a fix, returns False if it is not newer than the stored one."""
+        epoch = _epoch(timestamp)
+        with self._lock:
+            slot = self.index.slot(vehicle)
+            if slot is not None and epoch <= self.epoch[slot]:
+                self.stale += 1
+                return False
+            self.index.update(vehicle, lat, lon)
+            if len(self.epoch) < len(self.index.vehicles):
+                self.epoch = np.resize(self.epoch, len(self.index.vehicles))
+            self.epoch[self.index.slot(vehicle)] = epoch
+            self.applied += 1
+            return True
+
+    def warm_up(self, rows):
+        """Load the latest positions from BigQuery rows (see query_bq) at cold start."""
+        for row in rows:
+            self.update(row.vehicle, row.timestamp, row.lat, row.lon)
+
+    def consume(self, message):
+        """Pub/Sub callback: apply every fix carried by the message and ack it."""
+        for payload in decode_payload(message.data):
+            self.update(int(payload["vehicle"]), payload["timestamp"], float(payload["lat"]), float(payload["lon"]))
+        message.ack()
+
+    def subscribe(self, subscriber, subscription_path):
+        """Start consuming a subscription, returns the streaming pull future."""
+        return subscriber.subscribe(subscription_path, callback=self.consume)
+
+    def latest(self, vehicle):
+        """Latest Position of a vehicle, or None if it never reported."""
+        with self._lock:
+            slot = self.index.slot(vehicle)
+            if slot is None:
+                return None
+            return self._position(slot)
+
+    def _position(self, slot):
+        timestamp = datetime.datetime.fromtimestamp(self.epoch[slot], tz=datetime.timezone.utc)
+        return Position(int(self.index.vehicles[slot]), timestamp, float(self.index.lat[slot]), float(self.index.lon[slot]))
+
+    def positions(self):
+        """Latest Position of every vehicle, ordered by vehicle."""
+        with self._lock:
+            return sorted((self._position(slot) for slot in range(len(self.index))), key=lambda p: p.vehicle)
+
+    def nearest(self, lat, lon, k=1):
+        """The k nearest vehicles as a list of (vehicle, distance km)."""
+        with self._lock:
+            return self.index.nearest(lat, lon, k)
@@ -0,0 +1,278 @@
+# imports
+import json, math, threading, time
+from collections import namedtuple
+import numpy as np
+
+# side of a grid cell in degrees (~1.1 km of latitude), as in spatial_index
+cell_size = 0.01
+
+# transition kinds
+ENTER = "enter"
+EXIT = "exit"
+
+# polygon vertices are (lat, lon) pairs, the ring is closed implicitly
+Fence = namedtuple("Fence", ["name", "kind", "polygon"])
+Event = namedtuple("Event", ["vehicle", "timestamp", "fence", "kind", "transition"])
+
+# no fence around: shared by every empty cell
+_nothing = (frozenset(), ())
+
+
+def load_geojson(path, kind="zone"):
+    """Fences of the Polygon features of a GeoJSON file (outer rings only),
+    named after their "name" property."""
+    with open(path) as f:
+        features = json.load(f)["features"]
+    fences = []
+    for i, feature in enumerate(features):
+        geometry = feature["geometry"]
+        if geometry["type"] != "Polygon":
+            continue
+        properties = feature.get("properties") or {}
+        ring = [(lat, lon) for lon, lat in geometry["coordinates"][0]]
+        fences.append(Fence(properties.get("name", str(i)), properties.get("kind", kind), ring))
+    return fences
+
+
+def points_in_polygon(lats, lons, polygon):
+    """Vectorized ray casting: boolean array, True for the points inside."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    poly = np.asarray(polygon, dtype=float)
+    y0, x0 = poly[:, 0], poly[:, 1]
+    y1, x1 = np.roll(y0, -1), np.roll(x0, -1)
+    inside = np.zeros(lats.shape, dtype=bool)
+    for ya, xa, yb, xb in zip(y0, x0, y1, x1):
+        # edges straddling the horizontal line of the point, crossed on its right
+        straddle = (ya > lats) != (yb > lats)
+        if not straddle.any():
+            continue
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cross = xa + (lats - ya) * (xb - xa) / (yb - ya)
+        inside ^= straddle & (lons < cross)
+    return inside
+
+
+def _segment_hits_box(ya, xa, yb, xb, y0, x0, y1, x1):
+    """True if the segment (ya, xa)-(yb, xb) touches the box [y0, y1] x [x0, x1]
+    (Liang-Barsky clipping)."""
+    t0, t1 = 0.0, 1.0
+    dy, dx = yb - ya, xb - xa
+    for p, q in ((-dx, xa - x0), (dx, x1 - xa), (-dy, ya - y0), (dy, y1 - ya)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+class GeofenceIndex:
+    """Polygons indexed by a uniform lat/lon grid.
+
+    Built once: every grid cell overlapping a fence is classified as either
+    fully inside it or crossed by its border. A lookup is one dict read; only
+    fences whose border crosses the cell of the point need a point-in-polygon
+    test, so most fixes are answered without any geometry.
+    """
+
+    def __init__(self, fences, cell_size=cell_size):
+        self.fences = list(fences)
+        self.cell_size = cell_size
+        self._polygons = [np.asarray(f.polygon, dtype=float) for f in self.fences]
+        self._boxes = np.array([
+            (p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()) for p in self._polygons
+        ]).reshape(-1, 4)
+        # cell -> (fences containing the whole cell, fences crossing it)
+        self._cells = {}
+        inside, border = {}, {}
+        for i, polygon in enumerate(self._polygons):
+            crossed = self._border_cells(polygon)
+            for cell in crossed:
+                border.setdefault(cell, []).append(i)
+            # the other cells of the bounding box are inside or outside as a whole
+            y0, x0, y1, x1 = self._boxes[i]
+            (cy0, cx0), (cy1, cx1) = self._cell(y0, x0), self._cell(y1, x1)
+            cells = [(cy, cx) for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1) if (cy, cx) not in crossed]
+            if cells:
+                centers = np.array(cells, dtype=float) + 0.5
+                within = points_in_polygon(centers[:, 0] * cell_size, centers[:, 1] * cell_size, polygon)
+                for cell in np.array(cells)[within]:
+                    inside.setdefault(tuple(int(c) for c in cell), []).append(i)
+        for cell in set(inside) | set(border):
+            self._cells[cell] = (frozenset(inside.get(cell, ())), tuple(border.get(cell, ())))
+
+    def __len__(self):
+        return len(self.fences)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def _border_cells(self, polygon):
+        """Cells touched by the edges of a polygon."""
+        cells = set()
+        s = self.cell_size
+        for (ya, xa), (yb, xb) in zip(polygon, np.roll(polygon, -1, axis=0)):
+            (cy0, cx0), (cy1, cx1) = self._cell(min(ya, yb), min(xa, xb)), self._cell(max(ya, yb), max(xa, xb))
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    if _segment_hits_box(ya, xa, yb, xb, cy * s, cx * s, (cy + 1) * s, (cx + 1) * s):
+                        cells.add((cy, cx))
+        return cells
+
+    def _inside(self, i, lat, lon):
+        # scalar ray casting, cheaper than NumPy for a single point
+        polygon = self.fences[i].polygon
+        inside = False
+        ya, xa = polygon[-1]
+        for yb, xb in polygon:
+            if (ya > lat) != (yb > lat) and lon < xa + (lat - ya) * (xb - xa) / (yb - ya):
+                inside = not inside
+            ya, xa = yb, xb
+        return inside
+
+    def contains(self, lat, lon):
+        """Indices of the fences containing the point, as a frozenset."""
+        inside, border = self._cells.get((math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)), _nothing)
+        if not border:
+            return inside
+        return inside | frozenset(i for i in border if self._inside(i, lat, lon))
+
+    def contains_batch(self, lats, lons):
+        """Membership of many points at once: boolean array (points x fences).
+        Each fence only tests the points inside its bounding box."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = np.zeros((len(lats), len(self.fences)), dtype=bool)
+        for i, (y0, x0, y1, x1) in enumerate(self._boxes):
+            candidates = np.flatnonzero((lats >= y0) & (lats <= y1) & (lons >= x0) & (lons <= x1))
+            if len(candidates):
+                result[candidates, i] = points_in_polygon(lats[candidates], lons[candidates], self._polygons[i])
+        return result
+
+
+class GeofenceEngine:
+    """Enter/exit events of the vehicles, from their stream of fixes.
+
+    The fences containing each vehicle are kept per vehicle, so update() only
+    emits an Event when that set changes. Fixes older than the last one of the
+    vehicle are ignored, like in FleetState.
+    """
+
+    def __init__(self, index, on_event=None):
+        self.index = index
+        self.on_event = on_event
+        self._state = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        # counters
+        self.evaluated = 0
+        self.events = 0
+
+    def update(self, vehicle, timestamp, lat, lon):
+        """Apply a fix, returns the list of Events it causes."""
+        fences = self.index.contains(lat, lon)
+        with self._lock:
+            self.evaluated += 1
+            if timestamp < self._last.get(vehicle, timestamp):
+                return []
+            self._last[vehicle] = timestamp
+            previous = self._state.get(vehicle, frozenset())
+            if fences == previous:
+                return []
+            self._state[vehicle] = fences
+        events = [self._event(vehicle, timestamp, i, EXIT) for i in sorted(previous - fences)]
+        events += [self._event(vehicle, timestamp, i, ENTER) for i in sorted(fences - previous)]
+        self.events += len(events)
+        if self.on_event is not None:
+            for event in events:
+                self.on_event(event)
+        return events
+
+    def _event(self, vehicle, timestamp, i, transition):
+        fence = self.index.fences[i]
+        return Event(vehicle, timestamp, fence.name, fence.kind, transition)
+
+    def consume(self, message):
+        """Pub/Sub callback: evaluate every fix carried by the message and ack it."""
+        from batching import decode_payload
+
+        self.update_rows(decode_payload(message.data))
+        message.ack()
+
+    def update_rows(self, rows):
+        """Apply already decoded fixes (payloads or batching.payload_to_row
+        rows) in time order; usable as a BatchConsumer sink."""
+        events = []
+        for r in sorted(rows, key=lambda r: r["timestamp"]):
+            events += self.update(int(r["vehicle"]), r["timestamp"], float(r["lat"]), float(r["lon"]))
+        return events
+
+    def inside(self, vehicle):
+        """Names of the fences a vehicle is in."""
+        return sorted(self.index.fences[i].name for i in self._state.get(vehicle, ()))
+
+
+def trajectory_events(index, vehicle, timestamps, lats, lons):
+    """Enter/exit Events over a whole trajectory, in one vectorized pass:
+    membership of every fix, then the changes between consecutive fixes."""
+    if len(timestamps) == 0:
+        return []
+    member = index.contains_batch(lats, lons)
+    # the vehicle starts outside every fence
+    change = np.diff(np.vstack([np.zeros((1, member.shape[1]), dtype=bool), member]).astype(np.int8), axis=0)
+    rows, fences = np.nonzero(change)
+    return [
+        Event(vehicle, timestamps[r], index.fences[f].name, index.fences[f].kind, ENTER if change[r, f] > 0 else EXIT)
+        for r, f in zip(rows.tolist(), fences.tolist())
+    ]
+
+
+def history_events(index, cache, vehicles=None):
+    """Enter/exit Events of the vehicles_data history (a columnar_cache.FleetCache)."""
+    events = []
+    for vehicle in vehicles if vehicles is not None else cache.vehicles.tolist():
+        timestamps, lons, lats = cache.trajectory(vehicle)
+        events += trajectory_events(index, vehicle, np.asarray(timestamps), np.asarray(lats), np.asarray(lons))
+    return events
+
+
+def benchmark_geofence(fences, cache):
+    """Per-fix streaming cost and batch throughput over the whole history."""
+    index = GeofenceIndex(fences)
+    lats, lons = np.asarray(cache.lat), np.asarray(cache.lon)
+    pairs = list(zip(lats.tolist(), lons.tolist()))
+    start = time.perf_counter()
+    for lat, lon in pairs:
+        index.contains(lat, lon)
+    streaming = time.perf_counter() - start
+    start = time.perf_counter()
+    index.contains_batch(lats, lons)
+    batch = time.perf_counter() - start
+    start = time.perf_counter()
+    events = history_events(index, cache)
+    history = time.perf_counter() - start
+    return {
+        "fixes": len(pairs),
+        "contains_ns": streaming * 1e9 / len(pairs),
+        "batch_ns": batch * 1e9 / len(pairs),
+        "history_seconds": history,
+        "history_events": len(events),
+    }
+
+
+if __name__ == "__main__":
+    from columnar_cache import load_cache
+
+    # example zones in Beijing: a service area (about the 4th ring road) and a depot
+    example = [
+        Fence("service_area", "service", [(39.83, 116.27), (39.83, 116.49), (40.0, 116.49), (40.0, 116.27)]),
+        Fence("depot_east", "depot", [(39.90, 116.45), (39.905, 116.47), (39.915, 116.47), (39.92, 116.455), (39.91, 116.44)]),
+    ]
+    print(benchmark_geofence(example, load_cache()))
@@ -0,0 +1,207 @@
+# imports
+import time
+import datetime, functools
+from collections import namedtuple
+import numpy as np
+from spatial_index import haversine
+
+from columnar_cache import load_cache
+
+# time slice of the bucket index in seconds
+slice_seconds = 3600
+# geohash precision of the bucket index (6 characters: ~1.2 x 0.6 km)
+geohash_precision = 6
+
+# a position in time, interpolated or recorded
+Sample = namedtuple("Sample", ["vehicle", "epoch", "lat", "lon"])
+# closest approach of a vehicle to the query point
+Encounter = namedtuple("Encounter", ["vehicle", "epoch", "lat", "lon", "distance"])
+
+_base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def _epoch(t):
+    """Epoch seconds of an int, a timestamp string or a datetime (no zone: UTC,
+    like the columnar cache)."""
+    if isinstance(t, str):
+        t = datetime.datetime.fromisoformat(t)
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=datetime.timezone.utc)
+        return t.timestamp()
+    return float(t)
+
+
+def _bits(precision):
+    """(latitude bits, longitude bits) of a geohash of `precision` characters."""
+    total = 5 * precision
+    return total // 2, total - total // 2
+
+
+def geohash_cells(lats, lons, precision=geohash_precision):
+    """(row, column) of the geohash cells of the points: the integer grid
+    geohash interleaves, so cell neighbours are plain index +- 1."""
+    lat_bits, lon_bits = _bits(precision)
+    rows = np.floor((np.asarray(lats, dtype=float) + 90.0) / 180.0 * (1 << lat_bits)).astype(np.int64)
+    cols = np.floor((np.asarray(lons, dtype=float) + 180.0) / 360.0 * (1 << lon_bits)).astype(np.int64)
+    return np.clip(rows, 0, (1 << lat_bits) - 1), np.clip(cols, 0, (1 << lon_bits) - 1)
+
+
+def geohash(lat, lon, precision=geohash_precision):
+    """Base32 geohash string of a point."""
+    lat_bits, lon_bits = _bits(precision)
+    row, col = (int(v[()]) for v in geohash_cells(lat, lon, precision))
+    code = 0
+    # bits alternate starting with longitude
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            lon_bits -= 1
+            code = (code << 1) | ((col >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            code = (code << 1) | ((row >> lat_bits) & 1)
+    return "".join(_base32[(code >> (5 * (precision - 1 - i))) & 31] for i in range(precision))
+
+
+class HistoryIndex:
+    """Local query engine over the vehicles_data history.
+
+    Position at time: every vehicle's fixes are a contiguous, time-sorted
+    slice of the columnar cache, so a binary search (np.searchsorted) finds
+    the two fixes around t and the position is interpolated between them.
+
+    Vehicles near a point in a window: every fix is bucketed by (time slice,
+    geohash cell) and the rows are sorted by bucket key, so a query only
+    reads the buckets overlapping the window and the circle, then filters
+    them exactly. Repeated queries are answered from an LRU cache.
+    """
+
+    def __init__(self, cache=None, slice_seconds=slice_seconds, precision=geohash_precision, cache_size=1024):
+        self.cache = cache if cache is not None else load_cache()
+        self.slice_seconds = slice_seconds
+        self.precision = precision
+        self.epoch = np.asarray(self.cache.timestamp, dtype=np.int64)
+        self.lat = np.asarray(self.cache.lat)
+        self.lon = np.asarray(self.cache.lon)
+        self.vehicle = np.asarray(self.cache.vehicle)
+
+        start = time.perf_counter()
+        lat_bits, lon_bits = _bits(precision)
+        self._cols = 1 << lon_bits
+        self._rows = 1 << lat_bits
+        self._t0 = int(self.epoch.min()) if len(self.epoch) else 0
+        rows, cols = geohash_cells(self.lat, self.lon, precision)
+        keys = self._key(self._slice(self.epoch), rows, cols)
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+        self.build_seconds = time.perf_counter() - start
+        self.near = functools.lru_cache(maxsize=cache_size)(self._near)
+
+    def _slice(self, epoch):
+        return (np.asarray(epoch, dtype=np.int64) - self._t0) // self.slice_seconds
+
+    def _key(self, slices, rows, cols):
+        return (slices * self._rows + rows) * self._cols + cols
+
+    def position_at(self, vehicle, t, max_gap=None):
+        """Sample of a vehicle at time t, linearly interpolated between the
+        fixes around it. None before its first or after its last fix, or when
+        the fixes around t are more than max_gap seconds apart."""
+        t = _epoch(t)
+        rows = self.cache.rows(vehicle)
+        times = self.epoch[rows]
+        i = int(np.searchsorted(times, t, side="right"))
+        if i == 0 or (i == len(times) and t > times[-1]):
+            return None
+        a = rows.start + i - 1
+        if times[i - 1] == t or i == len(times):
+            return Sample(vehicle, t, float(self.lat[a]), float(self.lon[a]))
+        b = a + 1
+        gap = self.epoch[b] - self.epoch[a]
+        if max_gap is not None and gap > max_gap:
+            return None
+        w = (t - self.epoch[a]) / gap
+        return Sample(vehicle, t, float(self.lat[a] + w * (self.lat[b] - self.lat[a])),
+                      float(self.lon[a] + w * (self.lon[b] - self.lon[a])))
+
+    def positions_at(self, t, vehicles=None, max_gap=None):
+        """Samples of every vehicle known at time t."""
+        vehicles = vehicles if vehicles is not None else self.cache.vehicles.tolist()
+        samples = (self.position_at(v, t, max_gap) for v in vehicles)
+        return [s for s in samples if s is not None]
+
+    def candidates(self, lat, lon, radius, t0, t1):
+        """Rows in the buckets overlapping the window and the circle."""
+        dlat = np.degrees(radius / 6371.0088)
+        dlon = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 89.0))), 1e-6)
+        (r0, r1), (c0, c1) = geohash_cells([lat - dlat, lat + dlat], [lon - dlon, lon + dlon], self.precision)
+        slices = np.arange(self._slice(t0), self._slice(t1) + 1)
+        rows = np.arange(r0, r1 + 1)
+        # every (slice, row) pair covers a contiguous key range c0..c1
+        starts = self._key(slices[:, None], rows[None, :], c0).ravel()
+        ends = starts + (c1 - c0)
+        lo = np.searchsorted(self._keys, starts, side="left")
+        hi = np.searchsorted(self._keys, ends, side="right")
+        if not (hi > lo).any():
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._order[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a])
+
+    def _near(self, lat, lon, radius, t0, t1):
+        t0, t1 = _epoch(t0), _epoch(t1)
+        rows = self.candidates(lat, lon, radius, t0, t1)
+        if len(rows):
+            rows = rows[(self.epoch[rows] >= t0) & (self.epoch[rows] <= t1)]
+        if not len(rows):
+            return ()
+        d = haversine(lat, lon, self.lat[rows], self.lon[rows])
+        keep = d <= radius
+        rows, d = rows[keep], d[keep]
+        # closest fix of every vehicle: sort by (vehicle, distance), first of each
+        order = np.lexsort((d, self.vehicle[rows]))
+        rows, d = rows[order], d[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = self.vehicle[rows[1:]] != self.vehicle[rows[:-1]]
+        encounters = [
+            Encounter(int(self.vehicle[r]), int(self.epoch[r]), float(self.lat[r]), float(self.lon[r]), float(x))
+            for r, x in zip(rows[first].tolist(), d[first].tolist())
+        ]
+        return tuple(sorted(encounters, key=lambda e: e.distance))
+
+    def near_brute_force(self, lat, lon, radius, t0, t1):
+        """Same answer as near(), scanning every fix (for checks)."""
+        t0, t1 = _epoch(t0), _epoch(t1)
+        rows = np.flatnonzero((self.epoch >= t0) & (self.epoch <= t1))
+        d = haversine(lat, lon, self.lat[rows], self.lon[rows])
+        best = {}
+        for r, x in zip(rows[d <= radius].tolist(), d[d <= radius].tolist()):
+            v = int(self.vehicle[r])
+            if v not in best or x < best[v][1]:
+                best[v] = (r, x)
+        return tuple(sorted((Encounter(v, int(self.epoch[r]), float(self.lat[r]), float(self.lon[r]), x)
+                             for v, (r, x) in best.items()), key=lambda e: e.distance))
+
+
+if __name__ == "__main__":
+    index = HistoryIndex()
+    print("Index of {} fixes built in {:.3f}s".format(len(index.epoch), index.build_seconds))
+
+    rng = np.random.default_rng(0)
+    vehicles = rng.choice(index.cache.vehicles, 10000)
+    times = rng.integers(index.epoch.min(), index.epoch.max(), 10000)
+    start = time.perf_counter()
+    for v, t in zip(vehicles.tolist(), times.tolist()):
+        index.position_at(v, t)
+    print("position_at: {:.1f} us per query".format((time.perf_counter() - start) * 1e6 / len(times)))
+
+    # one hour windows around random fixes, 2 km radius
+    queries = [(float(index.lat[i]), float(index.lon[i]), 2.0, int(index.epoch[i]) - 1800, int(index.epoch[i]) + 1800)
+               for i in rng.integers(0, len(index.epoch), 200).tolist()]
+    for label in ("near (cold)", "near (cached)"):
+        start = time.perf_counter()
+        for q in queries:
+            index.near(*q)
+        print("{}: {:.3f} ms per query".format(label, (time.perf_counter() - start) * 1e3 / len(queries)))
+    start = time.perf_counter()
+    for q in queries[:20]:
+        index.near_brute_force(*q)
+    print("brute force: {:.3f} ms per query".format((time.perf_counter() - start) * 1e3 / 20))
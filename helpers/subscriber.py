@@ -1,7 +1,13 @@
-from concurrent.futures import TimeoutError
+from concurrent.futures import TimeoutError, ThreadPoolExecutor
 from google.cloud import pubsub_v1
 from dotenv import dotenv_values
-import os
+import os, time, argparse
+
+from batching import decode_payload
+from batch_consumer import BatchConsumer
+from geofence import GeofenceIndex, GeofenceEngine, load_geojson
+from bigquery_writer import PositionsWriter, StorageWriteTransport
+import metrics
 
 # TODO(developer)
 # project_id = "your-project-id"
@@ -9,36 +15,119 @@ import os
 # Number of seconds the subscriber should listen for messages
 
 
-# read .env file for envirnoment variables
-config = dotenv_values(".env")
+subscription = "vehicle_realtime_positions"
+bqCollection = "vehicles_positions"
+bqOutputTable = "positions"
 
-timeout = 120.0
+# lag of the single-message mode, a no-op unless metrics are enabled
+lag = metrics.noop
+# enter/exit events of the fixes, when --geofences is given
+geofences = None
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config["GOOGLE_APPLICATION_CREDENTIALS_WEBCLIENT"]
+def callback(message: pubsub_v1.subscriber.message.Message) -> None:
+    # a message carries a single fix or a batch of them
+    fixes = decode_payload(message.data)
+    for data in fixes:
+        print(f"Received {data}.")
+    if geofences is not None:
+        try:
+            geofences.update_rows(fixes)
+        except Exception as e:
+            print(f"Geofence evaluation failed: {e}")
+            message.nack()
+            return
+    message.ack()
+    lag.observe(time.time() - message.publish_time.timestamp())
 
-subscription = "vehicle_realtime_positions"
+def with_geofences(sink):
+    """Batched mode: evaluate the geofences on the decoded rows, then store
+    them; an evaluation error fails the batch, which is nacked."""
+    def evaluate_and_store(rows):
+        geofences.update_rows(rows)
+        return sink(rows)
+    return evaluate_and_store
 
-subscriber = pubsub_v1.SubscriberClient()
+def count_sink(rows):
+    """Default sink of the batched mode: only counts the rows."""
+    print(f"Received batch of {len(rows)} fixes.")
 
-# The `subscription_path` method creates a fully qualified identifier
-# in the form `projects/{project_id}/subscriptions/{subscription_id}`
-subscription_path = subscriber.subscription_path(config["GOOGLE_CLOUD_PROJECT_ID"], subscription)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Listen to the vehicle positions subscription.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to listen")
+    parser.add_argument("--batched", action="store_true", help="micro-batch the fixes into a sink and ack after it succeeds")
+    parser.add_argument("--max-messages", type=int, default=1000, help="flow control: outstanding messages")
+    parser.add_argument("--max-bytes", type=int, default=100 * 1024 * 1024, help="flow control: outstanding bytes")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per batch")
+    parser.add_argument("--batch-latency", type=float, default=1.0, help="max seconds before a batch is flushed")
+    parser.add_argument("--workers", type=int, default=4, help="callback and sink threads")
+    parser.add_argument("--sink", choices=["count", "bigquery"], default="count", help="where the batches go")
+    parser.add_argument("--geofences", default=None, help="GeoJSON polygons: print the enter/exit events of the vehicles")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this port")
+    parser.add_argument("--metrics-file", default=None, help="dump JSON metrics to this file every 10 s")
+    args = parser.parse_args()
 
-def callback(message: pubsub_v1.subscriber.message.Message) -> None:
-    data = message.data.decode("UTF-8")
-    print(f"Received {data}.")
-    message.ack()
+    if args.metrics_port or args.metrics_file:
+        metrics.enable()
+        lag = metrics.registry.histogram("subscriber_lag_seconds", "Pub/Sub publish time to ack")
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        if args.metrics_file:
+            metrics.dump(args.metrics_file)
+
+    # read .env file for envirnoment variables
+    config = dotenv_values(".env")
+
+    timeout = args.timeout
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config["GOOGLE_APPLICATION_CREDENTIALS_WEBCLIENT"]
+
+    subscriber = pubsub_v1.SubscriberClient()
+
+    # The `subscription_path` method creates a fully qualified identifier
+    # in the form `projects/{project_id}/subscriptions/{subscription_id}`
+    subscription_path = subscriber.subscription_path(config["GOOGLE_CLOUD_PROJECT_ID"], subscription)
+
+    if args.geofences:
+        geofences = GeofenceEngine(GeofenceIndex(load_geojson(args.geofences)), on_event=lambda e: print(f"Geofence {e}."))
+
+    consumer = None
+    if args.batched:
+        sink = writer = count_sink
+        if args.sink == "bigquery":
+            # micro-batches straight into the positions table (Storage Write API)
+            sink = writer = PositionsWriter(StorageWriteTransport(config["GOOGLE_CLOUD_PROJECT_ID"], bqCollection, bqOutputTable))
+        if geofences is not None:
+            sink = with_geofences(sink)
+        consumer = BatchConsumer(sink, max_rows=args.batch_size, max_latency=args.batch_latency, workers=args.workers)
+        streaming_pull_future = subscriber.subscribe(
+            subscription_path,
+            callback=consumer.consume,
+            flow_control=pubsub_v1.types.FlowControl(max_messages=args.max_messages, max_bytes=args.max_bytes),
+            scheduler=pubsub_v1.subscriber.scheduler.ThreadScheduler(ThreadPoolExecutor(max_workers=args.workers)),
+        )
+    else:
+        streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
 
-streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+    print(f"Listening for messages on {subscription_path}..\n")
 
-print(f"Listening for messages on {subscription_path}..\n")
+    # Wrap subscriber in a 'with' block to automatically call close() when done.
+    with subscriber:
+        try:
+            # When `timeout` is not set, result() will block indefinitely,
+            # unless an exception is encountered first.
+            streaming_pull_future.result(timeout=timeout)
+        except TimeoutError:
+            if consumer is not None:
+                # flush the last batch while the stream still sends its acks
+                consumer.close()
+            streaming_pull_future.cancel()  # Trigger the shutdown.
+            streaming_pull_future.result()  # Block until the shutdown is complete.
+        if consumer is not None:
+            # no-op after a timeout, flushes the last batch after a stream error
+            consumer.close()
 
-# Wrap subscriber in a 'with' block to automatically call close() when done.
-with subscriber:
-    try:
-        # When `timeout` is not set, result() will block indefinitely,
-        # unless an exception is encountered first.
-        streaming_pull_future.result(timeout=timeout)
-    except TimeoutError:
-        streaming_pull_future.cancel()  # Trigger the shutdown.
-        streaming_pull_future.result()  # Block until the shutdown is complete.
\ No newline at end of file
+    if consumer is not None:
+        consumer.report()
+        if isinstance(writer, PositionsWriter):
+            print("Writer:", writer.stats())
+            writer.close()
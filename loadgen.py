@@ -0,0 +1,184 @@
+"""Load generator: replay many vehicles through many MQTT connections.
+
+Vehicles are sharded across a multiprocessing pool. Every worker opens its own
+MQTT connection(s) and keeps its own replay cursor per vehicle, then publishes
+at its share of the target aggregate rate for the given duration. Vehicle ids
+above the 200 T-Drive trajectories are synthetic: vehicle v replays the file
+of vehicle ((v - 1) % 200) + 1 under its own id.
+
+Examples:
+    # in-process fake broker, all 200 trajectories, 2000 msg/s for 30 s
+    python loadgen.py --vehicles 200 --rate 2000 --duration 30
+    # local mosquitto, 10k synthetic vehicles on 8 processes
+    python loadgen.py --broker localhost --vehicles 10000 --workers 8 --rate 20000
+"""
+
+# imports
+import argparse, json, time
+import multiprocessing
+import paho.mqtt.client as mqtt
+from columnar_cache import load_cache
+from trajectory import fix_to_payload
+from batching import BatchingPublisher, JSON_ARRAY, BINARY
+
+
+class FakeClient:
+    """In-process stand-in for mqtt.Client: accepts publishes and counts them."""
+
+    def __init__(self, client_id=""):
+        self.client_id = client_id
+        self.published = 0
+        self.bytes = 0
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid += 1
+        self.published += 1
+        self.bytes += len(payload or b"")
+        info = mqtt.MQTTMessageInfo(self._mid)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def connect(client_id, broker, port):
+    """Plain (no TLS, no JWT) connection to a local broker, or a FakeClient."""
+    if broker is None:
+        return FakeClient(client_id)
+    client = mqtt.Client(client_id=client_id, clean_session=True)
+    client.connect(broker, port)
+    client.loop_start()
+    return client
+
+
+class VehicleCursor:
+    """Replay position of one (possibly synthetic) vehicle in the fleet cache.
+    Loops back to the first fix at the end of the trajectory."""
+
+    def __init__(self, cache, vehicle):
+        self.vehicle = vehicle
+        source = (vehicle - 1) % len(cache.vehicles) + 1
+        self._rows = cache.rows(source)
+        self._cache = cache
+        self._next = self._rows.start
+
+    def next_fix(self):
+        fix = self._cache.fix(self._next)
+        self._next += 1
+        if self._next == self._rows.stop:
+            self._next = self._rows.start
+        return fix._replace(vehicle=self.vehicle)
+
+
+def run_worker(worker, vehicles, rate, duration, connections, broker, port, batch=0, batch_format=JSON_ARRAY, batch_latency=1.0):
+    """Publish fixes of the given vehicles at `rate` messages per second.
+    With batch > 0 fixes go through a BatchingPublisher per connection.
+    Returns a dict of counters, collected by the parent process."""
+    cache = load_cache()
+    cursors = [VehicleCursor(cache, v) for v in vehicles]
+    device_ids = ["loadgen-{}-{}".format(worker, c) for c in range(connections)]
+    clients = [connect(device_id, broker, port) for device_id in device_ids]
+    # master topic of each connection
+    master_topics = ["/devices/{}/events".format(device_id) for device_id in device_ids]
+    batchers = []
+    if batch:
+        batchers = [BatchingPublisher(c, max_messages=batch, max_latency=batch_latency, format=batch_format).start() for c in clients]
+
+    sent = 0
+    errors = 0
+    payload_bytes = 0
+    start = time.monotonic()
+    stop = start + duration
+    while True:
+        # deadline of the next message: keeps the rate steady, no drift
+        deadline = start + sent / rate if rate else start
+        now = time.monotonic()
+        if now >= stop:
+            break
+        if deadline > now:
+            time.sleep(min(deadline, stop) - now)
+            continue
+        i = sent % len(cursors)
+        cursor = cursors[i]
+        # every vehicle always publishes through the same connection
+        c = i % len(clients)
+        fix = cursor.next_fix()
+        topic = master_topics[c] + "/" + str(fix.vehicle)
+        sent += 1
+        if batchers:
+            batchers[c].publish(topic, fix_to_payload(fix))
+            continue
+        payload = json.dumps(fix_to_payload(fix)).encode(encoding="UTF-8")
+        info = clients[c].publish(topic, payload=payload, qos=0, retain=False)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            errors += 1
+        payload_bytes += len(payload)
+    elapsed = time.monotonic() - start
+
+    # messages and bytes actually published
+    messages = sent
+    for batcher in batchers:
+        batcher.close()
+    if batchers:
+        messages = sum(b.messages for b in batchers)
+        payload_bytes = sum(b.bytes for b in batchers)
+
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+    return {"worker": worker, "vehicles": len(vehicles), "sent": sent, "messages": messages, "errors": errors,
+            "bytes": payload_bytes, "elapsed": elapsed}
+
+
+def shard(vehicles, workers):
+    """Split the vehicles in `workers` interleaved shards."""
+    return [vehicles[w::workers] for w in range(workers) if vehicles[w::workers]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-process MQTT load generator for the vehicles replay.")
+    parser.add_argument("--vehicles", type=int, default=200, help="number of vehicles (above 200 are synthetic)")
+    parser.add_argument("--rate", type=float, default=1000.0, help="target aggregate messages per second (0: unbounded)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="worker processes")
+    parser.add_argument("--connections", type=int, default=1, help="MQTT connections per worker")
+    parser.add_argument("--broker", default=None, help="local MQTT broker host (default: in-process fake)")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--batch", type=int, default=0, help="fixes per batched message (0: one message per fix)")
+    parser.add_argument("--batch-format", choices=[JSON_ARRAY, BINARY, "struct", "delta"], default=JSON_ARRAY, help="payload of a batch")
+    parser.add_argument("--batch-latency", type=float, default=1.0, help="max seconds a fix waits in a batch")
+    args = parser.parse_args(argv)
+
+    # build the cache once in the parent, workers only map it
+    load_cache()
+
+    shards = shard(list(range(1, args.vehicles + 1)), args.workers)
+    worker_rate = args.rate / len(shards)
+    jobs = [(w, s, worker_rate, args.duration, args.connections, args.broker, args.port,
+             args.batch, args.batch_format, args.batch_latency) for w, s in enumerate(shards)]
+
+    print("Load: {} vehicles on {} workers x {} connections, target {} msg/s for {}s against {}".format(
+        args.vehicles, len(shards), args.connections, args.rate or "unbounded", args.duration, args.broker or "fake broker"))
+    with multiprocessing.Pool(len(shards)) as pool:
+        results = pool.starmap(run_worker, jobs)
+
+    sent = sum(r["sent"] for r in results)
+    messages = sum(r["messages"] for r in results)
+    errors = sum(r["errors"] for r in results)
+    elapsed = max(r["elapsed"] for r in results)
+    total_bytes = sum(r["bytes"] for r in results)
+    print("Sent {} fixes in {} messages ({} errors, {} payload bytes) in {:.2f}s: {:.0f} fixes/s, {:.0f} msg/s".format(
+        sent, messages, errors, total_bytes, elapsed, sent / elapsed if elapsed else 0.0, messages / elapsed if elapsed else 0.0))
+    return results
+
+
+if __name__ == "__main__":
+    main()
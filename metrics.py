@@ -0,0 +1,261 @@
+"""Counters, gauges and histograms for the publish and subscribe hot paths.
+
+Metrics are off by default: until enable() is called, registry hands out a
+shared no-op instrument, so instrumented code pays one empty method call.
+Components create their instruments when they are built, so call enable()
+before building them (e.g. the ConnectionManager or the BatchConsumer).
+
+Exposure, once enabled:
+    serve(port)            Prometheus text format on http://localhost:port/metrics
+    dump(path, interval)   JSON snapshot rewritten every interval seconds
+
+Example:
+    import metrics
+    metrics.enable()
+    metrics.serve(9100)
+"""
+
+# imports
+import json, os, threading, time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default histogram buckets, seconds from 1 ms to 1 min
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# default buckets of sizes (rows or messages per batch)
+size_buckets = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Counter:
+    """Monotonic count."""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge:
+    """Current value, set by the code or read when collected from the fn of
+    every instance that registered one, each under its own labels."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        # label string -> fn; once a fn was added the value is not used
+        self.fns = {}
+        self._read = False
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    @staticmethod
+    def _key(labels):
+        return ",".join('{}="{}"'.format(k, v) for k, v in sorted((labels or {}).items()))
+
+    def add(self, fn, labels=None):
+        """Read fn at collection, under labels (a dict); it replaces the fn
+        of a previous instance registered under the same labels."""
+        with self._lock:
+            self.fns[self._key(labels)] = fn
+            self._read = True
+
+    def remove(self, labels=None, fn=None):
+        """Stop reading the fn under labels (only if it is still fn, when
+        given), e.g. when its instance is closed."""
+        key = self._key(labels)
+        with self._lock:
+            if key in self.fns and (fn is None or self.fns[key] is fn):
+                del self.fns[key]
+
+    def samples(self):
+        with self._lock:
+            fns = list(self.fns.items())
+        if not self._read:
+            return [(self.name, self.value)]
+        return [("{}{{{}}}".format(self.name, key) if key else self.name, fn()) for key, fn in fns]
+
+
+class Histogram:
+    """Distribution of observations over fixed cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # one count per bucket plus +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (approximate)."""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, seen = q * count, 0
+        for bound, c in zip(self.buckets + (float("inf"),), counts):
+            seen += c
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples, cumulative = [], 0
+        for bound, c in zip(self.buckets, counts):
+            cumulative += c
+            samples.append(('{}_bucket{{le="{}"}}'.format(self.name, bound), cumulative))
+        samples.append(('{}_bucket{{le="+Inf"}}'.format(self.name), count))
+        samples.append((self.name + "_sum", total))
+        samples.append((self.name + "_count", count))
+        return samples
+
+
+class _Noop:
+    """Stand-in for every instrument while metrics are disabled."""
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def remove(self, labels=None, fn=None):
+        pass
+
+
+noop = _Noop()
+
+
+class Registry:
+    """Named instruments. Asking twice for a name returns the same instrument
+    (a gauge then reads one more fn, see Gauge.add and Gauge.remove)."""
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        if not self.enabled:
+            return noop
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help="", fn=None, labels=None):
+        """Gauge `name`; with fn its value is read from fn, under labels
+        (e.g. {"device": device_id}) when several instances report it."""
+        gauge = self._get(Gauge, name, help)
+        if fn is not None and gauge is not noop:
+            gauge.add(fn, labels)
+        return gauge
+
+    def histogram(self, name, help="", buckets=latency_buckets):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.append("# HELP {} {}".format(m.name, m.help))
+            lines.append("# TYPE {} {}".format(m.name, m.kind))
+            lines += ["{} {}".format(name, value) for name, value in m.samples()]
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Every sample as {name: value}, histograms as count, sum, p50 and p99."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {"time": time.time()}
+        for m in metrics:
+            snapshot.update((name, value) for name, value in m.samples() if "_bucket{" not in name)
+            if m.kind == "histogram":
+                snapshot[m.name + "_p50"] = m.quantile(0.5)
+                snapshot[m.name + "_p99"] = m.quantile(0.99)
+        return snapshot
+
+
+# process-wide registry used by the instrumented modules
+registry = Registry()
+
+
+def enable():
+    registry.enabled = True
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve registry.render() on /metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Metrics on http://{}:{}/metrics".format(host, server.server_port))
+    return server
+
+
+def dump(path, interval=10.0):
+    """Rewrite registry.snapshot() as JSON to path every interval seconds,
+    from a daemon thread. Returns an Event stopping it."""
+    stopped = threading.Event()
+
+    def loop():
+        while not stopped.wait(interval):
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(registry.snapshot(), f, indent=1, sort_keys=True)
+            os.replace(tmp, path)
+
+    threading.Thread(target=loop, daemon=True).start()
+    return stopped
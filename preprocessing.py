@@ -0,0 +1,207 @@
+# imports
+import numpy as np
+
+# downsampling methods
+GATE = "gate"
+DOUGLAS_PEUCKER = "dp"
+
+# mean earth radius in meters
+earth_radius = 6371008.8
+
+
+def _local_xy(lon, lat):
+    """Equirectangular projection in meters around the mean latitude, accurate
+    enough over the few km between consecutive fixes of a vehicle."""
+    lat0 = np.radians(np.mean(lat)) if len(lat) else 0.0
+    x = np.radians(lon) * np.cos(lat0) * earth_radius
+    y = np.radians(lat) * earth_radius
+    return x, y
+
+
+def duplicates_mask(timestamp, lon, lat):
+    """False for the fixes repeating the previous one exactly."""
+    keep = np.ones(len(timestamp), dtype=bool)
+    keep[1:] = (timestamp[1:] != timestamp[:-1]) | (lon[1:] != lon[:-1]) | (lat[1:] != lat[:-1])
+    return keep
+
+
+def speed_mask(timestamp, lon, lat, max_speed, max_passes=8):
+    """False for GPS jumps: fixes reached from the previous fix and left
+    towards the next one faster than max_speed km/h (a spike). The first
+    (last) fix is a jump when it is too fast from (to) both of the two
+    following (preceding) fixes, so a spike next to it does not take it away.
+    Fixes at the same second in different places count as infinitely fast.
+    Every pass compares consecutive kept fixes, so clusters of jumps are
+    removed in a few passes."""
+    keep = np.ones(len(timestamp), dtype=bool)
+    x, y = _local_xy(lon, lat)
+    limit = max_speed / 3.6
+
+    def too_fast(a, b):
+        dt = (timestamp[b] - timestamp[a]).astype(float)
+        d = np.hypot(x[b] - x[a], y[b] - y[a])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(dt > 0, d / dt, np.where(d > 0, np.inf, 0.0)) > limit
+
+    for _ in range(max_passes):
+        idx = np.flatnonzero(keep)
+        if len(idx) < 3:
+            break
+        fast = too_fast(idx[:-1], idx[1:])
+        incoming = np.zeros(len(idx), dtype=bool)
+        outgoing = np.zeros(len(idx), dtype=bool)
+        incoming[1:] = fast
+        outgoing[:-1] = fast
+        # the ends have a single neighbour: check them against the next one too
+        incoming[0] = too_fast(idx[0], idx[2])
+        outgoing[-1] = too_fast(idx[-3], idx[-1])
+        bad = incoming & outgoing
+        if not bad.any():
+            break
+        keep[idx[bad]] = False
+    return keep
+
+
+def gate_mask(timestamp, lon, lat, min_distance, max_interval):
+    """Keep a fix every min_distance meters travelled along the path, and at
+    least one every max_interval seconds (so parked vehicles still report).
+    The first and last fix are always kept."""
+    n = len(timestamp)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    if min_distance:
+        x, y = _local_xy(lon, lat)
+        travelled = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+        step = np.floor(travelled / min_distance)
+        keep[1:] |= step[1:] != step[:-1]
+    if max_interval:
+        bucket = (timestamp - timestamp[0]) // max_interval
+        keep[1:] |= bucket[1:] != bucket[:-1]
+    return keep
+
+
+def douglas_peucker_mask(lon, lat, tolerance):
+    """Douglas-Peucker simplification: keep the fewest fixes such that the
+    dropped ones are within tolerance meters of the simplified path. Uses an
+    explicit stack (no recursion limit) and measures each segment in one
+    vectorized pass."""
+    n = len(lon)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    x, y = _local_xy(lon, lat)
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        px, py = x[first + 1:last], y[first + 1:last]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        length = np.hypot(dx, dy)
+        if length > 0:
+            d = np.abs(dx * (py - y[first]) - dy * (px - x[first])) / length
+        else:
+            d = np.hypot(px - x[first], py - y[first])
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+class Preprocessor:
+    """Clean and thin the trajectories before they are published.
+
+    Runs on the column arrays of the columnar cache, one vehicle at a time:
+    exact duplicates are dropped, then impossible speeds (GPS jumps), then the
+    trajectory is downsampled with a distance/time gate or Douglas-Peucker.
+    Each stage can be disabled by setting its parameter to None (or 0).
+    Rows in and out of every stage are counted, see stats() and report().
+
+    Args:
+     max_speed: km/h above which a fix is a jump (None: no speed filter)
+     method: GATE, DOUGLAS_PEUCKER or None (no downsampling)
+     min_distance: GATE, meters travelled between kept fixes
+     max_interval: GATE, seconds after which a fix is kept anyway
+     tolerance: DOUGLAS_PEUCKER, meters of allowed deviation
+    """
+
+    def __init__(self, dedupe=True, max_speed=200.0, method=GATE, min_distance=100.0, max_interval=300, tolerance=20.0):
+        if method not in (GATE, DOUGLAS_PEUCKER, None):
+            raise ValueError("Unknown downsampling method {}".format(method))
+        self.dedupe = dedupe
+        self.max_speed = max_speed
+        self.method = method
+        self.min_distance = min_distance
+        self.max_interval = max_interval
+        self.tolerance = tolerance
+        self.counts = {"input": 0, "duplicates": 0, "jumps": 0, "downsampled": 0, "output": 0}
+
+    def mask(self, timestamp, lon, lat):
+        """Boolean mask of the fixes to keep in one vehicle trajectory."""
+        timestamp = np.asarray(timestamp)
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        keep = np.ones(len(timestamp), dtype=bool)
+        self.counts["input"] += len(keep)
+
+        stages = []
+        if self.dedupe:
+            stages.append(("duplicates", duplicates_mask))
+        if self.max_speed:
+            stages.append(("jumps", lambda t, x, y: speed_mask(t, x, y, self.max_speed)))
+        if self.method == GATE:
+            stages.append(("downsampled", lambda t, x, y: gate_mask(t, x, y, self.min_distance, self.max_interval)))
+        elif self.method == DOUGLAS_PEUCKER:
+            stages.append(("downsampled", lambda t, x, y: douglas_peucker_mask(x, y, self.tolerance)))
+
+        for name, stage in stages:
+            # every stage only sees the fixes kept by the previous ones
+            idx = np.flatnonzero(keep)
+            kept = stage(timestamp[idx], lon[idx], lat[idx])
+            keep[idx[~kept]] = False
+            self.counts[name] += int(len(idx) - kept.sum())
+
+        self.counts["output"] += int(keep.sum())
+        return keep
+
+    def trajectory(self, cache, vehicle, start_row=0):
+        """Indices (into the cache columns) of the kept fixes of a vehicle,
+        starting at row start_row of its trajectory."""
+        rows = cache.rows(vehicle)
+        s = slice(rows.start + start_row, rows.stop)
+        keep = self.mask(cache.timestamp[s], cache.lon[s], cache.lat[s])
+        return s.start + np.flatnonzero(keep)
+
+    def streams(self, cache, vehicles, start_row=0):
+        """One iterator of Fix per vehicle, ready for replay.ReplayScheduler."""
+        return [(cache.fix(int(i)) for i in self.trajectory(cache, v, start_row)) for v in vehicles]
+
+    def reduction(self):
+        """Fraction of the input fixes dropped."""
+        return 1.0 - self.counts["output"] / self.counts["input"] if self.counts["input"] else 0.0
+
+    def stats(self):
+        return dict(self.counts, reduction=self.reduction())
+
+    def report(self):
+        c = self.counts
+        print("Preprocessing: {} fixes in, {} out ({:.1%} dropped: {} duplicates, {} jumps, {} downsampled)".format(
+            c["input"], c["output"], self.reduction(), c["duplicates"], c["jumps"], c["downsampled"]))
+
+
+if __name__ == "__main__":
+    from columnar_cache import load_cache
+
+    cache = load_cache()
+    for method in (None, GATE, DOUGLAS_PEUCKER):
+        preprocessor = Preprocessor(method=method)
+        for vehicle in cache.vehicles:
+            preprocessor.mask(*cache.trajectory(int(vehicle)))
+        print("method {}:".format(method), end=" ")
+        preprocessor.report()
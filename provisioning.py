@@ -0,0 +1,142 @@
+# imports
+import json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from google.api_core import exceptions
+
+# local record of the resources known to exist
+state_file = ".provisioning_state.json"
+
+# results meaning "the resource is already there"
+exists_errors = (exceptions.AlreadyExists, exceptions.Conflict)
+
+# step outcomes
+CREATED = "created"
+EXISTS = "exists"
+CACHED = "cached"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Step:
+    """One resource to provision.
+
+    Args:
+     name: unique name of the step
+     action: callable creating the resource. Like the setters of this repo
+             it may return an exception instead of raising it
+     depends: names of the steps that must succeed first
+     key: identity of the resource (e.g. its full path); a cached "exists"
+          is only trusted for the same key
+    """
+
+    def __init__(self, name, action, depends=(), key=None):
+        self.name = name
+        self.action = action
+        self.depends = tuple(depends)
+        self.key = key or name
+
+
+class Provisioner:
+    """Run provisioning steps as a dependency graph on a thread pool.
+
+    Steps whose dependencies are satisfied run concurrently, so independent
+    network round trips (e.g. the topic and the BigQuery dataset) overlap.
+    Steps that created or found their resource are recorded in state_file;
+    on a warm restart they are skipped without any remote call, until the
+    record is older than max_age seconds. A failed step skips its dependents.
+    """
+
+    def __init__(self, steps, max_workers=4, state_file=state_file, max_age=24 * 3600, exists_errors=exists_errors):
+        self.steps = {s.name: s for s in steps}
+        for s in steps:
+            for d in s.depends:
+                if d not in self.steps:
+                    raise ValueError("Step {} depends on unknown step {}".format(s.name, d))
+        self.max_workers = max_workers
+        self.state_file = state_file
+        self.max_age = max_age
+        self.exists_errors = exists_errors
+        self._lock = threading.Lock()
+        self._state = self._load_state()
+
+    def _load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _cached(self, step):
+        entry = self._state.get(step.name)
+        return entry is not None and entry["key"] == step.key and time.time() - entry["at"] < self.max_age
+
+    def _run_step(self, step):
+        """Returns (outcome, result, seconds)."""
+        if self._cached(step):
+            return CACHED, None, 0.0
+        start = time.perf_counter()
+        try:
+            result = step.action()
+        except Exception as e:
+            result = e
+        seconds = time.perf_counter() - start
+        if isinstance(result, self.exists_errors):
+            outcome = EXISTS
+        elif isinstance(result, Exception):
+            return FAILED, result, seconds
+        else:
+            outcome = CREATED
+        with self._lock:
+            self._state[step.name] = {"key": step.key, "at": time.time()}
+        return outcome, result, seconds
+
+    def run(self, force=False):
+        """Provision every step. Returns {name: (outcome, result, seconds)}."""
+        if force:
+            self._state = {}
+        results = {}
+        pending = dict(self.steps)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # submit every ready step, skip the dependents of failures
+                progress = True
+                while progress:
+                    progress = False
+                    for name, step in list(pending.items()):
+                        if any(results.get(d, (None,))[0] in (FAILED, SKIPPED) for d in step.depends):
+                            results[name] = (SKIPPED, None, 0.0)
+                            print("Step {}: skipped, a dependency failed".format(name))
+                        elif all(d in results for d in step.depends):
+                            running[pool.submit(self._run_step, step)] = name
+                        else:
+                            continue
+                        del pending[name]
+                        progress = True
+                if not running:
+                    if pending:
+                        raise ValueError("Dependency cycle between steps {}".format(", ".join(pending)))
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    outcome, result, seconds = results[name]
+                    if outcome == FAILED:
+                        print("Step {}: failed ({}) in {:.2f}s".format(name, result, seconds))
+                    else:
+                        print("Step {}: {} in {:.2f}s".format(name, outcome, seconds))
+
+        self._save_state()
+        return results
@@ -0,0 +1,114 @@
+# imports
+import time, heapq
+import datetime
+
+# how often (seconds of wall clock) lag is reported while replaying
+report_interval = 30.0
+
+
+def fix_epoch(fix):
+    """Epoch seconds of a fix timestamp (the files carry no zone, read as UTC)."""
+    return datetime.datetime.fromisoformat(fix.timestamp).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class ReplayScheduler:
+    """Merge many vehicle streams by timestamp and emit each fix on time.
+
+    Every stream is an iterator of trajectory.Fix sorted by timestamp (e.g. a
+    TrajectoryCursor). A heap keeps the next fix of each stream, so the fleet
+    is replayed in global time order. Each fix gets a deadline on the
+    monotonic clock:
+
+        start + (fix time - first fix time) / speedup
+
+    and the loop sleeps until that deadline, never for a fixed interval, so
+    time spent parsing and publishing is not added on top and the replay does
+    not drift. When emitting is slower than the deadlines the lag is measured
+    and reported instead of silently piling up.
+
+    Args:
+     streams: iterable of iterators of Fix
+     speedup: 1 replays in real time, 60 one minute of data per second,
+             0 (or None) as fast as possible
+     max_gap: if set, idle gaps in the data longer than max_gap seconds are
+             shortened to max_gap (the T-Drive files have gaps of days)
+    """
+
+    def __init__(self, streams, speedup=1.0, max_gap=None, report_interval=report_interval):
+        self.speedup = speedup
+        self.max_gap = max_gap
+        self.report_interval = report_interval
+        self._heap = []
+        self._streams = []
+        for stream in streams:
+            self._streams.append(iter(stream))
+            self._push(len(self._streams) - 1)
+        # lag statistics
+        self.emitted = 0
+        self.late = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def _push(self, i):
+        fix = next(self._streams[i], None)
+        if fix is not None:
+            # the stream index breaks ties, Fix objects are never compared
+            heapq.heappush(self._heap, (fix_epoch(fix), i, fix))
+
+    def __len__(self):
+        """Number of streams that still have fixes to emit."""
+        return len(self._heap)
+
+    def stats(self):
+        return {
+            "emitted": self.emitted,
+            "late": self.late,
+            "max_lag": self.max_lag,
+            "mean_lag": self.total_lag / self.late if self.late else 0.0,
+        }
+
+    def report(self):
+        s = self.stats()
+        print("Replay: {} fixes emitted, {} late (mean lag {:.3f}s, max lag {:.3f}s)".format(
+            s["emitted"], s["late"], s["mean_lag"], s["max_lag"]))
+
+    def run(self, emit, limit=None):
+        """Emit fixes with emit(fix) at their scheduled time until all streams
+        are exhausted (or limit fixes were emitted). Returns the stats."""
+        fast = not self.speedup
+        start = time.monotonic()
+        next_report = start + self.report_interval
+        # data time mapped to the start of the replay
+        origin = self._heap[0][0] if self._heap else 0.0
+        previous = origin
+
+        while self._heap and (limit is None or self.emitted < limit):
+            epoch, i, fix = heapq.heappop(self._heap)
+
+            if self.max_gap is not None and epoch - previous > self.max_gap:
+                # pull the rest of the replay forward in data time
+                origin += epoch - previous - self.max_gap
+            previous = epoch
+
+            now = time.monotonic()
+            if not fast:
+                deadline = start + (epoch - origin) / self.speedup
+                if deadline > now:
+                    time.sleep(deadline - now)
+                else:
+                    lag = now - deadline
+                    # fixes due on the same instant are not late
+                    if lag > 0.001:
+                        self.late += 1
+                        self.total_lag += lag
+                        self.max_lag = max(self.max_lag, lag)
+
+            emit(fix)
+            self.emitted += 1
+            self._push(i)
+
+            if self.report_interval and now >= next_report:
+                self.report()
+                next_report = now + self.report_interval
+
+        return self.stats()
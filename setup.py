@@ -0,0 +1,29 @@
+"""Modules shared by the vehicle clients, the subscriber and the Cloud
+Function (helpers/), installed as top-level modules.
+
+    pip install -e .    # locally, also done by requirements.txt
+    pip wheel --no-deps . -w helpers/wheels    # before deploying helpers/ (see helpers/requirements.txt)
+"""
+
+# imports
+from setuptools import setup
+
+setup(
+    name="pcc-shared",
+    version="0.1.0",
+    description="Modules shared by the PCC clients, subscriber and Cloud Function",
+    py_modules=[
+        "batch_consumer",
+        "batching",
+        "bigquery_writer",
+        "client_registry",
+        "codec",
+        "columnar_cache",
+        "metrics",
+        "replay",
+        "spatial_index",
+        "startup",
+        "trajectory",
+    ],
+    install_requires=["numpy"],
+)
@@ -0,0 +1,174 @@
+# imports
+import math
+import numpy as np
+
+# mean Earth radius in km
+earth_radius = 6371.0088
+
+# side of a grid cell in degrees (~1.1 km of latitude)
+cell_size = 0.01
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km, works on scalars and NumPy arrays."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    """Latest position of every vehicle, indexed by a uniform lat/lon grid.
+
+    Positions live in flat NumPy arrays (one slot per vehicle) and every grid
+    cell keeps the set of slots inside it, so moving a vehicle only touches
+    two cells: no rebuild is needed on updates. Queries visit the cells
+    around the point ring by ring and rank candidates by haversine distance.
+    """
+
+    def __init__(self, cell_size=cell_size, capacity=256):
+        self.cell_size = cell_size
+        self.vehicles = np.zeros(capacity, dtype=np.int64)
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self._slots = {}
+        self._cells = {}
+        self._cell_of = {}
+
+    @classmethod
+    def from_rows(cls, rows, cell_size=cell_size):
+        """Index rows with vehicle, lat and lon attributes (e.g. BigQuery rows)."""
+        index = cls(cell_size)
+        for row in rows:
+            index.update(row.vehicle, row.lat, row.lon)
+        return index
+
+    def __len__(self):
+        return len(self._slots)
+
+    def slot(self, vehicle):
+        """Array slot of a vehicle (slots are 0..len-1), None if not indexed."""
+        return self._slots.get(vehicle)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def update(self, vehicle, lat, lon):
+        """Insert or move a vehicle."""
+        slot = self._slots.get(vehicle)
+        if slot is None:
+            slot = len(self._slots)
+            if slot == len(self.vehicles):
+                # grow the arrays geometrically
+                self.vehicles = np.resize(self.vehicles, 2 * slot)
+                self.lat = np.resize(self.lat, 2 * slot)
+                self.lon = np.resize(self.lon, 2 * slot)
+            self._slots[vehicle] = slot
+            self.vehicles[slot] = vehicle
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+
+        cell = self._cell(lat, lon)
+        previous = self._cell_of.get(slot)
+        if previous != cell:
+            if previous is not None:
+                self._cells[previous].discard(slot)
+            self._cells.setdefault(cell, set()).add(slot)
+            self._cell_of[slot] = cell
+
+    def remove(self, vehicle):
+        """Drop a vehicle, the last slot is moved in its place."""
+        slot = self._slots.pop(vehicle)
+        self._cells[self._cell_of.pop(slot)].discard(slot)
+        last = len(self._slots)
+        if slot != last:
+            moved = int(self.vehicles[last])
+            self.vehicles[slot] = moved
+            self.lat[slot] = self.lat[last]
+            self.lon[slot] = self.lon[last]
+            self._slots[moved] = slot
+            cell = self._cell_of.pop(last)
+            self._cells[cell].discard(last)
+            self._cells[cell].add(slot)
+            self._cell_of[slot] = cell
+
+    def _ring(self, cx, cy, r):
+        """Slots in the cells at Chebyshev distance r from (cx, cy)."""
+        slots = []
+        for x in range(cx - r, cx + r + 1):
+            for y in range(cy - r, cy + r + 1):
+                if max(abs(x - cx), abs(y - cy)) == r:
+                    slots.extend(self._cells.get((x, y), ()))
+        return slots
+
+    def nearest(self, lat, lon, k=1):
+        """The k nearest vehicles as a list of (vehicle, distance km)."""
+        n = len(self._slots)
+        if n == 0:
+            return []
+        k = min(k, n)
+        cx, cy = self._cell(lat, lon)
+        # km per cell along latitude
+        km_lat = math.radians(self.cell_size) * earth_radius
+        candidates = []
+        r = 0
+        while True:
+            if (2 * r + 1) ** 2 > n:
+                # visiting more cells than there are vehicles: scan them all
+                candidates = list(self._slots.values())
+                break
+            candidates.extend(self._ring(cx, cy, r))
+            if len(candidates) >= k:
+                d = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+                kth = np.partition(d, k - 1)[k - 1]
+                # anything outside the visited square is at least this far
+                # (longitude cells narrow with latitude, 1% margin for the chord)
+                km_lon = km_lat * math.cos(math.radians(min(abs(lat) + (r + 1) * self.cell_size, 89.0)))
+                if kth <= 0.99 * r * min(km_lat, km_lon):
+                    break
+            r += 1
+        slots = np.array(candidates)
+        d = haversine(lat, lon, self.lat[slots], self.lon[slots])
+        order = np.argsort(d)[:k]
+        return [(int(self.vehicles[slots[i]]), float(d[i])) for i in order]
+
+    def within(self, lat, lon, radius):
+        """Vehicles within radius km, nearest first, as (vehicle, distance km)."""
+        dlat = math.degrees(radius / earth_radius)
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.0))), 1e-6)
+        x0, y0 = self._cell(lat - dlat, lon - dlon)
+        x1, y1 = self._cell(lat + dlat, lon + dlon)
+        slots = [s for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) for s in self._cells.get((x, y), ())]
+        if not slots:
+            return []
+        slots = np.array(slots)
+        d = haversine(lat, lon, self.lat[slots], self.lon[slots])
+        inside = np.flatnonzero(d <= radius)
+        inside = inside[np.argsort(d[inside])]
+        return [(int(self.vehicles[slots[i]]), float(d[i])) for i in inside]
+
+    def nearest_batch(self, lats, lons, k=1, chunk=1024):
+        """k nearest vehicles of many points at once.
+
+        One vectorized pass over a (points x vehicles) distance matrix,
+        computed `chunk` points at a time to bound memory.
+        Returns (vehicles, distances), two arrays of shape (points, k).
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        n = len(self._slots)
+        k = min(k, n)
+        vehicles = np.empty((len(lats), k), dtype=np.int64)
+        if k == 0:
+            return vehicles, np.empty((len(lats), 0))
+        distances = np.empty((len(lats), k))
+        lat, lon = self.lat[:n], self.lon[:n]
+        for start in range(0, len(lats), chunk):
+            stop = start + chunk
+            d = haversine(lats[start:stop, None], lons[start:stop, None], lat[None, :], lon[None, :])
+            best = np.argpartition(d, k - 1, axis=1)[:, :k] if k < n else np.tile(np.arange(n), (len(d), 1))
+            best_d = np.take_along_axis(d, best, axis=1)
+            order = np.argsort(best_d, axis=1)
+            best = np.take_along_axis(best, order, axis=1)
+            vehicles[start:stop] = self.vehicles[best]
+            distances[start:stop] = np.take_along_axis(best_d, order, axis=1)
+        return vehicles, distances
@@ -0,0 +1,432 @@
+"""Store-and-forward spool: fixes survive broker outages and restarts.
+
+Publishes are appended to a per-device spool directory first, then a drain
+thread forwards the backlog to the broker at a controlled rate whenever the
+connection is up, so the replay never blocks on the network.
+
+Layout of spool/{device_id}/:
+    000000000000.seg, 000000000001.seg, ...   append-only segments
+    cursor                                    last acknowledged position
+
+A segment is a sequence of records:
+    >I body length | >I crc32 of body | body = >B qos, >H topic length, topic, payload
+Segments are rotated at segment_size bytes; a sealed segment never changes,
+so it can be memory-mapped and read without copying. Forwarded segments are
+deleted. On restart the tail of the last segment is checked and a torn
+record (crash in the middle of an append) is cut, then forwarding resumes
+at the cursor: delivery is at least once.
+"""
+
+# imports
+import collections, functools, glob, itertools, mmap, os, struct, threading, time, zlib
+import metrics
+
+# spool root, one sub-folder per device
+spool_dir = "spool"
+
+header = struct.Struct(">II")
+body_header = struct.Struct(">BH")
+cursor_record = struct.Struct(">QQQ")
+
+
+class Spool:
+    """Append-only, segmented, crash-safe record log of one device.
+
+    Args:
+     directory: folder of the segments (created if missing)
+     segment_size: bytes after which a new segment is started
+     max_bytes: disk cap; beyond it the oldest segment is dropped (counted)
+     fsync: fsync every append (survives power loss, much slower)
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self.appended = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        # counters
+        self.dropped = 0
+        self.truncated_bytes = 0
+
+        self._cursor_path = os.path.join(directory, "cursor")
+        # committed position: (segment, byte offset, records before it in the segment)
+        self._committed = self._load_cursor()
+        segments = sorted(int(os.path.basename(p)[:-4]) for p in glob.glob(os.path.join(directory, "*.seg")))
+        for seq in segments:
+            if seq < self._committed[0]:
+                # forwarded, the crash came before its removal
+                os.remove(self._path(seq))
+        self._segments = [s for s in segments if s >= self._committed[0]] or [self._committed[0]]
+        if self._segments[0] != self._committed[0]:
+            self._committed = (self._segments[0], 0, 0)
+        # records and bytes of every segment
+        self._counts = {}
+        self._sizes = {}
+        for seq in self._segments:
+            self._counts[seq], self._sizes[seq] = self._scan(seq, truncate=seq == self._segments[-1])
+        if self._committed[1] > self._sizes[self._segments[0]]:
+            # cursor beyond a cut tail
+            self._committed = (self._segments[0], self._sizes[self._segments[0]], self._counts[self._segments[0]])
+        self._read = self._committed
+        self._writer = open(self._path(self._segments[-1]), "ab")
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "{:012d}.seg".format(seq))
+
+    def _load_cursor(self):
+        try:
+            with open(self._cursor_path, "rb") as f:
+                return cursor_record.unpack(f.read(cursor_record.size))
+        except (OSError, struct.error):
+            return (0, 0, 0)
+
+    def _scan(self, seq, truncate=False):
+        """(records, valid bytes) of a segment; with truncate a torn or
+        corrupt tail is cut off the file."""
+        path = self._path(seq)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        size = os.path.getsize(path)
+        records, offset = 0, 0
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while offset + header.size <= size:
+                    length, crc = header.unpack_from(data, offset)
+                    end = offset + header.size + length
+                    if end > size or zlib.crc32(data[offset + header.size:end]) != crc:
+                        break
+                    records += 1
+                    offset = end
+        if truncate and offset < size:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+            self.truncated_bytes += size - offset
+            print("Spool {}: cut {} bytes of a torn record".format(self.directory, size - offset))
+        return records, offset
+
+    def append(self, topic, payload, qos=0):
+        """Write one message at the end of the spool."""
+        topic = topic.encode("UTF-8")
+        body = body_header.pack(qos, len(topic)) + topic + payload
+        record = header.pack(len(body), zlib.crc32(body)) + body
+        with self._lock:
+            seq = self._segments[-1]
+            if self._sizes[seq] and self._sizes[seq] + len(record) > self.segment_size:
+                seq = self._rotate()
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._counts[seq] += 1
+            self._sizes[seq] += len(record)
+            if sum(self._sizes.values()) > self.max_bytes and len(self._segments) > 1:
+                self._drop_oldest()
+        self.appended.set()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Same call as the MQTT clients, so a spool can stand in for one
+        (e.g. under a BatchingPublisher)."""
+        self.append(topic, payload or b"", qos)
+
+    def _rotate(self):
+        self._writer.close()
+        seq = self._segments[-1] + 1
+        self._segments.append(seq)
+        self._counts[seq] = self._sizes[seq] = 0
+        self._writer = open(self._path(seq), "ab")
+        return seq
+
+    def _drop_oldest(self):
+        seq = self._segments.pop(0)
+        lost = self._counts.pop(seq)
+        self._sizes.pop(seq)
+        if self._committed[0] == seq:
+            lost -= self._committed[2]
+        self.dropped += lost
+        self._committed = max(self._committed, (self._segments[0], 0, 0))
+        self._read = max(self._read, self._committed)
+        self._save_cursor()
+        os.remove(self._path(seq))
+
+    def read(self, max_records=500):
+        """Next records after the read position, without consuming them:
+        [(topic, payload, qos, position)]; commit(position) consumes up to
+        and including the record."""
+        records = []
+        with self._lock:
+            seq, offset, index = self._read
+            while len(records) < max_records:
+                size = self._sizes.get(seq, 0)
+                if offset >= size:
+                    if seq == self._segments[-1]:
+                        break
+                    seq, offset, index = self._segments[self._segments.index(seq) + 1], 0, 0
+                    continue
+                with open(self._path(seq), "rb") as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                    while offset < size and len(records) < max_records:
+                        length, _ = header.unpack_from(data, offset)
+                        start = offset + header.size
+                        qos, topic_length = body_header.unpack_from(data, start)
+                        topic_start = start + body_header.size
+                        topic = data[topic_start:topic_start + topic_length].decode("UTF-8")
+                        offset = start + length
+                        index += 1
+                        records.append((topic, data[topic_start + topic_length:offset], qos, (seq, offset, index)))
+            self._read = (seq, offset, index)
+        return records
+
+    def rewind(self):
+        """Read again from the last committed position (after a failed send)."""
+        with self._lock:
+            self._read = self._committed
+
+    def commit(self, position):
+        """Mark everything up to position as forwarded: persist the cursor
+        and delete the segments left behind."""
+        with self._lock:
+            if position <= self._committed:
+                return
+            self._committed = position
+            self._save_cursor()
+            while self._segments[0] < position[0]:
+                seq = self._segments.pop(0)
+                self._counts.pop(seq)
+                self._sizes.pop(seq)
+                os.remove(self._path(seq))
+
+    def _save_cursor(self):
+        tmp = self._cursor_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(cursor_record.pack(*self._committed))
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self._cursor_path)
+
+    def backlog(self):
+        """(records, bytes) appended and not yet committed."""
+        with self._lock:
+            seq, offset, index = self._committed
+            records = sum(self._counts[s] for s in self._segments) - index
+            size = sum(self._sizes[s] for s in self._segments) - offset
+            return records, size
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+
+
+class SpoolForwarder:
+    """Drain thread forwarding a spool to the broker.
+
+    While connected() is true it reads the spool in batches and calls
+    send(topic, payload, 1, on_sent) for every record, at most `rate` per
+    second; on_sent tells the mid the client gave it. Records are published with qos 1 and a position is only
+    committed once the broker has acknowledged every record up to it
+    (acked(mid), wired to the client's on_publish), so a message still in
+    the client's queue when the connection drops or the process crashes is
+    sent again: delivery is at least once. lost() (wired to on_disconnect)
+    forgets the unacknowledged messages and reads again from the last
+    acknowledged position. At most max_pending messages wait for their ack.
+
+    Args:
+     spool: the Spool to drain
+     send: callable (topic, payload, qos, on_sent) -> bool, False when the
+       message can not be queued; on_sent(mid) is called once the client
+       took it, on_sent(None) if it refused it (ConnectionManager.try_publish)
+     connected: callable telling if the connection is up
+     rate: records per second, 0 for no limit
+    """
+
+    def __init__(self, spool, send, connected, rate=1000.0, batch=200, max_pending=1000, report_interval=30.0):
+        self.spool = spool
+        self.send = send
+        self.connected = connected
+        self.rate = rate
+        self.batch = batch
+        self.max_pending = max_pending
+        self.report_interval = report_interval
+        self._stopped = threading.Event()
+        self._thread = None
+        # send sequence -> [position, acked], in send order
+        self._pending = collections.OrderedDict()
+        self._sequence = itertools.count()
+        # mid -> send sequence, known once the client took the message
+        self._mids = {}
+        self._acked_position = None
+        # bumped by lost(): sends of an older connection are not tracked
+        self._generation = 0
+        self._rewind = False
+        self._lock = threading.Lock()
+        self._progress = threading.Event()
+        # counters
+        self.forwarded = 0
+        self.acked_count = 0
+        self.failures = 0
+        self.lost_count = 0
+        self._window = (time.monotonic(), 0)
+        self.throughput = 0.0
+        registry = metrics.registry
+        self._forwarded = registry.counter("spool_forwarded_total", "spooled messages acknowledged by the broker")
+        # (gauge, fn) removed by stop(), the fns keep this instance alive
+        self._labels = {"spool": spool.directory}
+        self._gauges = []
+        for name, help, fn in (
+            ("spool_backlog_records", "messages waiting in the spool", lambda: spool.backlog()[0]),
+            ("spool_backlog_bytes", "bytes waiting in the spool", lambda: spool.backlog()[1]),
+            ("spool_unacked", "spooled messages waiting for their ack", lambda: len(self._pending)),
+        ):
+            self._gauges.append((registry.gauge(name, help, fn=fn, labels=self._labels), fn))
+
+    def attach(self, connection):
+        """Wire the acks and disconnects of a vehicle.ConnectionManager."""
+        connection.on_ack = self.acked
+        connection.on_lost = self.lost
+        return self
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sent(self, seq, mid):
+        """on_sent of a record: its mid, or None if the client refused it."""
+        if mid is None:
+            self.lost()
+            return
+        with self._lock:
+            if seq in self._pending:
+                self._mids[mid] = seq
+
+    def acked(self, mid):
+        """on_publish: the broker acknowledged message mid."""
+        with self._lock:
+            entry = self._pending.get(self._mids.pop(mid, None))
+            if entry is None:
+                return
+            entry[1] = True
+            self._pop_acked()
+        self._progress.set()
+
+    def _pop_acked(self):
+        # the acknowledged prefix of the pending messages can be committed
+        while self._pending:
+            position, acked = next(iter(self._pending.values()))
+            if not acked:
+                break
+            self._pending.popitem(last=False)
+            self._acked_position = position
+            self.acked_count += 1
+            self._forwarded.inc()
+
+    def lost(self):
+        """on_disconnect: unacknowledged messages may be lost, send them again."""
+        with self._lock:
+            self._generation += 1
+            self.lost_count += len(self._pending)
+            self._pending.clear()
+            self._mids.clear()
+            self._rewind = True
+        self._progress.set()
+
+    def _commit(self):
+        """Commit the acknowledged position; after a disconnect read again from it."""
+        with self._lock:
+            position, self._acked_position = self._acked_position, None
+            rewind, self._rewind = self._rewind, False
+        if position is not None:
+            self.spool.commit(position)
+        if rewind:
+            self.spool.rewind()
+
+    def _run(self):
+        next_report = time.monotonic() + self.report_interval
+        while not self._stopped.is_set():
+            # taken before the rewind: records read after it belong to this connection
+            generation = self._generation
+            self._commit()
+            if self.report_interval and time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + self.report_interval
+            if not self.connected():
+                self._stopped.wait(0.5)
+                continue
+            if len(self._pending) >= self.max_pending:
+                # wait for acks before sending more
+                self._progress.clear()
+                self._progress.wait(0.1)
+                continue
+            self.spool.appended.clear()
+            records = self.spool.read(min(self.batch, self.max_pending - len(self._pending)))
+            if not records:
+                # wake up on the next append
+                self.spool.appended.wait(0.1)
+                continue
+            self._forward(records, generation)
+        self._commit()
+
+    def _forward(self, records, generation):
+        start = time.monotonic()
+        for i, (topic, payload, qos, position) in enumerate(records):
+            if self.rate:
+                # deadline of this record: steady rate, no drift
+                delay = start + i / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            with self._lock:
+                if generation != self._generation:
+                    # the connection was lost meanwhile: read again first
+                    self._rewind = True
+                    return
+                seq = next(self._sequence)
+                self._pending[seq] = [position, False]
+            if not self.send(topic, payload, 1, functools.partial(self._sent, seq)):
+                # not connected: the records after the acknowledged ones are read again
+                with self._lock:
+                    self._pending.pop(seq, None)
+                    self.failures += 1
+                    self._rewind = True
+                return
+            self.forwarded += 1
+
+    def stats(self):
+        now = time.monotonic()
+        started, forwarded = self._window
+        if now - started >= 1.0:
+            self.throughput = (self.forwarded - forwarded) / (now - started)
+            self._window = (now, self.forwarded)
+        records, size = self.spool.backlog()
+        return {
+            "backlog_records": records,
+            "backlog_bytes": size,
+            "forwarded": self.forwarded,
+            "acked": self.acked_count,
+            "unacked": len(self._pending),
+            "forwarded_per_second": self.throughput,
+            "send_failures": self.failures,
+            "lost_in_flight": self.lost_count,
+            "dropped": self.spool.dropped,
+        }
+
+    def report(self):
+        s = self.stats()
+        print("Spool: backlog {} messages ({} bytes), forwarded {} ({:.0f}/s), {} dropped".format(
+            s["backlog_records"], s["backlog_bytes"], s["forwarded"], s["forwarded_per_second"], s["dropped"]))
+
+    def stop(self, timeout=10.0):
+        """Try to forward the backlog and get it acknowledged, then stop the thread."""
+        deadline = time.monotonic() + timeout
+        while self.spool.backlog()[0] and self.connected() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        for gauge, fn in self._gauges:
+            gauge.remove(self._labels, fn)
+
+
+def open_spool(device_id, folder=spool_dir, **kwargs):
+    """Spool of a device, in folder/device_id."""
+    return Spool(os.path.join(folder, device_id), **kwargs)
@@ -0,0 +1,99 @@
+"""Startup profile: what importing an entry point costs a fresh interpreter.
+
+Every measure runs in a new Python process, so nothing is already imported
+(as on a Cloud Function cold start). The report lists the slowest modules
+(self time, from python -X importtime) and the import time of every top
+level package; with --budget-ms the exit code is 1 when the cold import of
+the target takes longer, so it can gate a deploy or CI step.
+
+Examples:
+    python startup.py helpers/cloud_function.py
+    python startup.py client_registry --top 10
+    python startup.py helpers/cloud_function.py --budget-ms 400
+"""
+
+# imports
+import argparse, importlib, os, subprocess, sys
+
+
+def lazy(module, name):
+    """Function `name` of `module`, imported on its first call: the module
+    (and what it imports) is only paid for when actually used."""
+
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module), name)(*args, **kwargs)
+
+    call.__name__ = name
+    return call
+
+
+def _import_code(target):
+    """Python code importing a module name or a .py path."""
+    if target.endswith(".py"):
+        folder, name = os.path.split(os.path.abspath(target))
+        return "import sys; sys.path.insert(0, {!r}); import {}".format(folder, os.path.splitext(name)[0])
+    return "import {}".format(target)
+
+
+def import_profile(target):
+    """[(module, self seconds, cumulative seconds)] of a cold import of target."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _import_code(target)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode:
+        raise RuntimeError("Importing {} failed:\n{}".format(target, result.stderr.strip().splitlines()[-1]))
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        rows.append((module.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return rows
+
+
+def cold_import_seconds(target, runs=3):
+    """Best wall time of importing target in a fresh interpreter."""
+    code = "import time; _t = time.perf_counter(); {}; print(time.perf_counter() - _t)".format(_import_code(target))
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds = float(result.stdout.strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def report(target, top=20):
+    rows = import_profile(target)
+    packages = {}
+    for module, own, _ in rows:
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + own
+    print("Slowest modules imported by {} (self time):".format(target))
+    for module, own, cumulative in sorted(rows, key=lambda r: -r[1])[:top]:
+        print("  {:50} {:8.1f} ms  (cumulative {:8.1f} ms)".format(module, own * 1e3, cumulative * 1e3))
+    print("Import time by package:")
+    for package, own in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+        print("  {:50} {:8.1f} ms".format(package, own * 1e3))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time profile and budget of an entry point.")
+    parser.add_argument("target", help="module name or .py path, e.g. helpers/cloud_function.py")
+    parser.add_argument("--top", type=int, default=20, help="modules and packages listed")
+    parser.add_argument("--runs", type=int, default=3, help="cold imports timed, the best one counts")
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail (exit code 1) above this cold import time")
+    args = parser.parse_args(argv)
+
+    report(args.target, args.top)
+    seconds = cold_import_seconds(args.target, args.runs)
+    print("Cold import of {}: {:.1f} ms".format(args.target, seconds * 1e3))
+    if args.budget_ms is not None and seconds * 1e3 > args.budget_ms:
+        print("Over the import budget of {:.0f} ms".format(args.budget_ms))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
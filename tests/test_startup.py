@@ -0,0 +1,38 @@
+"""Cold start of the Cloud Function: what importing it loads, and how long it takes.
+
+The budget defaults to 1000 ms, override it with IMPORT_BUDGET_MS.
+"""
+
+# imports
+import os, subprocess, sys, unittest
+import startup
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+TARGET = "helpers/cloud_function.py"
+BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1000"))
+
+
+def imported_modules(target):
+    """Names of the modules loaded by importing target in a fresh interpreter."""
+    code = "{}; print('\\n'.join(sorted(sys.modules)))".format(startup._import_code(target))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=ROOT, env=dict(os.environ, K_SERVICE=""))
+    return result.stdout.split()
+
+
+class ColdStartTest(unittest.TestCase):
+
+    def test_no_heavy_module_imported(self):
+        modules = imported_modules(TARGET)
+        heavy = [m for m in modules if m.split(".")[0] in ("google", "numpy")]
+        self.assertEqual(heavy, [], "imported on cold start, import them where they are used")
+
+    def test_import_within_budget(self):
+        seconds = startup.cold_import_seconds(TARGET)
+        self.assertLessEqual(seconds * 1e3, BUDGET_MS,
+                             "cold import of {} takes {:.1f} ms".format(TARGET, seconds * 1e3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# imports
+import os
+from bisect import bisect_left
+from collections import namedtuple
+
+# folder with the T-Drive trajectories, one file per vehicle
+data_dir = "vehicles_data"
+
+# read buffer for each open trajectory file
+buffer_size = 64 * 1024
+
+# a single GPS fix, the files are "id,timestamp,lon,lat"
+Fix = namedtuple("Fix", ["vehicle", "timestamp", "lon", "lat"])
+
+
+def parse_fix(line):
+    """Parse one raw line (bytes or str) of a vehicles_data file into a Fix."""
+    if isinstance(line, bytes):
+        line = line.decode("UTF-8")
+    vehicle, timestamp, lon, lat = line.strip().split(",")
+    return Fix(int(vehicle), timestamp.strip(), float(lon), float(lat))
+
+
+def trajectory_path(vehicle, folder=data_dir):
+    """Path of the trajectory file of a vehicle."""
+    return os.path.join(folder, "{}.txt".format(vehicle))
+
+
+class TrajectoryCursor:
+    """Forward cursor over the trajectory file of one vehicle.
+
+    The file is kept open with a read buffer, so next_fix() only reads the
+    following line instead of walking the file from the start. A line-offset
+    index (byte offset and timestamp of every row) is built once, on the first
+    seek, and lets seek_row()/seek_time() jump directly to any row.
+    """
+
+    def __init__(self, vehicle, folder=data_dir, buffering=buffer_size):
+        self.vehicle = vehicle
+        self.path = trajectory_path(vehicle, folder)
+        self._fp = open(self.path, "rb", buffering=buffering)
+        self._offsets = None
+        self._timestamps = None
+        # index of the row next_fix() will return
+        self.row = 0
+
+    def _build_index(self):
+        offsets = []
+        timestamps = []
+        self._fp.seek(0)
+        position = 0
+        for line in self._fp:
+            if line.strip():
+                offsets.append(position)
+                # timestamps are "YYYY-MM-DD HH:MM:SS", so they sort as text
+                timestamps.append(line.split(b",", 2)[1].strip().decode("UTF-8"))
+            position += len(line)
+        self._offsets = offsets
+        self._timestamps = timestamps
+
+    def __len__(self):
+        """Number of rows in the file (builds the index)."""
+        if self._offsets is None:
+            self._build_index()
+            self.seek_row(self.row)
+        return len(self._offsets)
+
+    def seek_row(self, row):
+        """Move the cursor so that next_fix() returns the given row."""
+        if self._offsets is None:
+            self._build_index()
+        if row < len(self._offsets):
+            self._fp.seek(self._offsets[row])
+        else:
+            # past the end: next_fix() returns None
+            self._fp.seek(0, os.SEEK_END)
+            row = len(self._offsets)
+        self.row = row
+        return row
+
+    def seek_time(self, timestamp):
+        """Move the cursor to the first fix recorded at or after timestamp.
+
+        Args:
+         timestamp: a "YYYY-MM-DD HH:MM:SS" string or a datetime
+        Returns:
+            The row the cursor now points to.
+        """
+        if self._offsets is None:
+            self._build_index()
+        if not isinstance(timestamp, str):
+            timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        return self.seek_row(bisect_left(self._timestamps, timestamp))
+
+    def next_fix(self):
+        """Return the next fix of the vehicle, or None at the end of the file."""
+        line = self._fp.readline()
+        while line and not line.strip():
+            line = self._fp.readline()
+        if not line:
+            return None
+        self.row += 1
+        return parse_fix(line)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        fix = self.next_fix()
+        if fix is None:
+            raise StopIteration
+        return fix
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_cursors(vehicles, folder=data_dir, start_row=0):
+    """Open one cursor per vehicle, positioned at start_row."""
+    cursors = {}
+    for v in vehicles:
+        cursor = TrajectoryCursor(v, folder)
+        if start_row:
+            cursor.seek_row(start_row)
+        cursors[v] = cursor
+    return cursors
+
+
+def fix_to_payload(fix):
+    """Message body published for a fix."""
+    return {
+        "vehicle": str(fix.vehicle),
+        "timestamp": fix.timestamp,
+        "lat": str(fix.lat),
+        "lon": str(fix.lon),
+    }
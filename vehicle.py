@@ -1,8 +1,21 @@
 # imports
-import os, jwt, ssl
+import os, jwt, select, socket, ssl
 import datetime, time
+import functools, random, threading
+from collections import deque
 import paho.mqtt.client as mqtt
 import json
+from cryptography.hazmat.primitives import serialization
+import metrics
+
+# lifetime of a JWT, Google IoT Core accepts at most 24 hours
+jwt_lifetime = datetime.timedelta(minutes=24)
+
+@functools.lru_cache(maxsize=None)
+def load_private_key(private_key_file):
+    """Read and parse a PEM private key once, later calls get the parsed key."""
+    with open(private_key_file, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None)
 
 # create token from Google Key
 def create_jwt(project_id, private_key_file, algorithm):
@@ -14,23 +27,23 @@ def create_jwt(project_id, private_key_file, algorithm):
      algorithm: The encryption algorithm to use. Either 'RS256' or 'ES256'
     Returns:
         A JWT generated from the given project_id and private key, which
-        expires in 20 minutes. After 20 minutes, your client will be
+        expires after jwt_lifetime. After that, your client will be
         disconnected, and a new JWT will have to be generated.
     Raises:
         ValueError: If the private_key_file does not contain a known key.
     """
 
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
     token = {
         # The time that the token was issued at
-        "iat": datetime.datetime.now(tz=datetime.timezone.utc),
+        "iat": now,
         # The time the token expires.
-        "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(minutes=24),
+        "exp": now + jwt_lifetime,
         # The audience field should always be set to the GCP project id.
         "aud": project_id,
     }
-    # Read the private key file.
-    with open(private_key_file, "r") as f:
-        private_key = f.read()
+    # Parsed private key, the file is read only on the first call.
+    private_key = load_private_key(private_key_file)
     print(
         "Creating JWT using {} from private key file {}".format(
             algorithm, private_key_file
@@ -92,6 +105,20 @@ def on_message(unused_client, unused_userdata, message):
         )
     )
 
+def add_command_handlers(client, device_id, vehicles, handler=None):
+    """Route the commands of every vehicle to handler(vehicle, command).
+    Commands for a vehicle are sent in its subfolder, i.e. on the topic
+    /devices/{device_id}/commands/{vehicle}; the others still reach on_message."""
+
+    def default_handler(vehicle, command):
+        print("Vehicle {} received command '{}'".format(vehicle, command))
+
+    handler = handler or default_handler
+    for vehicle in vehicles:
+        def callback(unused_client, unused_userdata, message, vehicle=vehicle):
+            handler(vehicle, message.payload.decode("utf-8"))
+        client.message_callback_add("/devices/{}/commands/{}".format(device_id, vehicle), callback)
+
 # create client
 def get_client(
     project_id,
@@ -143,3 +170,338 @@ def get_client(
     return client
 
 
+class ConnectionManager:
+    """MQTT connection to the Google bridge that survives JWT expiry and outages.
+
+    A single network thread drives the paho client (instead of loop_start)
+    and is the only one writing its socket: publish() and try_publish() only
+    queue the message and wake it up, so concurrent publishers can not
+    interleave partial packets on the TLS stream.
+    - the next JWT is minted refresh_margin seconds before the current one
+      expires, then the connection is rotated onto it;
+    - after a disconnect it reconnects with exponential backoff and full
+      jitter (between minimum_backoff and maximum_backoff seconds);
+    - publish() never blocks: the fixes wait in a bounded queue (the oldest
+      are dropped when it is full), also while disconnected, and are sent on
+      reconnect.
+    The arguments are the same as get_client. With metrics enabled (see
+    metrics.py) it records publishes, publish-to-ack latency, queue depth,
+    reconnects and JWT mint times.
+
+    on_ack(mid) is called for every acknowledged publish and on_lost() when
+    the connection drops (messages in flight may be lost), e.g. for a
+    SpoolForwarder committing only what the broker has acknowledged. Both
+    run in the network thread.
+    """
+
+    def __init__(
+        self,
+        project_id,
+        cloud_region,
+        registry_id,
+        device_id,
+        private_key_file,
+        algorithm,
+        ca_certs,
+        mqtt_bridge_hostname,
+        mqtt_bridge_port,
+        queue_size=10000,
+        refresh_margin=120,
+        minimum_backoff=1.0,
+        maximum_backoff=64.0,
+    ):
+        self.project_id = project_id
+        self.device_id = device_id
+        self.private_key_file = private_key_file
+        self.algorithm = algorithm
+        self.host = mqtt_bridge_hostname
+        self.port = mqtt_bridge_port
+        self.refresh_margin = refresh_margin
+        self.minimum_backoff = minimum_backoff
+        self.maximum_backoff = maximum_backoff
+
+        client_id = "projects/{}/locations/{}/registries/{}/devices/{}".format(
+            project_id, cloud_region, registry_id, device_id
+        )
+        self.client = mqtt.Client(client_id=client_id, clean_session=True)
+        self.client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_message = on_message
+        self.on_ack = None
+        self.on_lost = None
+
+        # (topic, payload, qos, retain, on_sent) waiting for the network thread:
+        # publish() messages, kept while disconnected, and try_publish() ones,
+        # dropped with the connection
+        self.queue = deque(maxlen=queue_size)
+        self._direct = deque()
+        self._lock = threading.Lock()
+        # wakes the network thread up when a message is queued
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._connected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._token = None
+        self._token_expiry = 0.0
+        self._next_token = None
+        self._attempts = 0
+        # socket open, waiting for the CONNACK
+        self._connecting = False
+        self._ever_connected = False
+        # counters
+        self.reconnects = 0
+        self.refreshes = 0
+        self.dropped = 0
+        self.jwt_seconds = 0.0
+        # metrics, no-ops unless metrics.enable() was called
+        registry = metrics.registry
+        self._published = registry.counter("mqtt_published_total", "messages handed to paho")
+        self._dropped = registry.counter("mqtt_dropped_total", "queued messages dropped, queue full")
+        self._reconnects = registry.counter("mqtt_reconnects_total", "connections after the first one")
+        self._refreshes = registry.counter("mqtt_jwt_refreshes_total", "connections rotated onto a new JWT")
+        self._ack_latency = registry.histogram("mqtt_publish_ack_seconds", "publish call to on_publish")
+        self._jwt_latency = registry.histogram("mqtt_jwt_mint_seconds", "JWT signing time")
+        # removed by stop(), the fn keeps this instance alive
+        self._queue_depth = lambda: len(self.queue)
+        self._gauge_labels = {"device": device_id}
+        self._queue_gauge = registry.gauge("mqtt_queue_depth", "messages waiting for a connection",
+                                           fn=self._queue_depth, labels=self._gauge_labels)
+        # mid -> publish time, and mids acked before publish() returned
+        self._timed = registry.enabled
+        self._sent = {}
+        self._acked = {}
+
+    def _mint(self):
+        """A fresh JWT and the monotonic time it expires at."""
+        start = time.perf_counter()
+        token = create_jwt(self.project_id, self.private_key_file, self.algorithm)
+        self.jwt_seconds = time.perf_counter() - start
+        self._jwt_latency.observe(self.jwt_seconds)
+        return token, time.monotonic() + jwt_lifetime.total_seconds()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        on_connect(client, userdata, flags, rc)
+        self._connecting = False
+        if rc == 0:
+            self._attempts = 0
+            if self._ever_connected:
+                self.reconnects += 1
+                self._reconnects.inc()
+            self._ever_connected = True
+            # clean session: subscribe again to the commands topic
+            client.subscribe("/devices/{}/commands/#".format(self.device_id), qos=1)
+            self._connected.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        on_disconnect(client, userdata, rc)
+        self._connecting = False
+        self._connected.clear()
+        # messages in flight are lost with the connection
+        with self._lock:
+            self._sent.clear()
+            self._acked.clear()
+            self._direct.clear()
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def _backoff(self):
+        # jittered exponential: uniform in [minimum, min(maximum, minimum * 2^(attempts - 1))]
+        delay = min(self.maximum_backoff, self.minimum_backoff * 2 ** (self._attempts - 1))
+        self._stopped.wait(random.uniform(self.minimum_backoff, max(self.minimum_backoff, delay)))
+
+    def _connect(self):
+        if self._next_token is not None:
+            self._token, self._token_expiry = self._next_token
+            self._next_token = None
+        elif self._token_expiry - time.monotonic() < self.refresh_margin:
+            self._token, self._token_expiry = self._mint()
+        self.client.username_pw_set(username="unused", password=self._token)
+        try:
+            self.client.connect(self.host, self.port)
+        except OSError as e:
+            print("connect failed:", e)
+            return False
+        self._connecting = True
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._connected.is_set() and not self._connecting:
+                # the first attempt (and a token rotation) is immediate,
+                # consecutive failures back off
+                if self._attempts:
+                    self._backoff()
+                if self._stopped.is_set():
+                    break
+                self._attempts += 1
+                if not self._connect():
+                    continue
+            remaining = self._token_expiry - time.monotonic()
+            if self._next_token is None and remaining < 2 * self.refresh_margin:
+                # pre-mint the next token, well before it is needed
+                self._next_token = self._mint()
+            if remaining < self.refresh_margin and self._connected.is_set():
+                # rotate the connection onto the new token before expiry
+                self.refreshes += 1
+                self._refreshes.inc()
+                self.client.disconnect()
+                self._connected.clear()
+            rc = self._loop(timeout=0.1)
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                # connection lost (on_disconnect already ran) or never established
+                self._connecting = False
+                self._connected.clear()
+                continue
+            if self._connected.is_set():
+                self._drain()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            # buffer full: a wake-up is already pending
+            pass
+
+    def _loop(self, timeout):
+        """One iteration of the paho network loop, also woken up by _wake()."""
+        sock = self.client.socket()
+        if sock is None:
+            return mqtt.MQTT_ERR_NO_CONN
+        if (self._connected.is_set() and (self.queue or self._direct)) or (hasattr(sock, "pending") and sock.pending()):
+            # work to do now (or TLS bytes already decrypted, select does not see them)
+            timeout = 0.0
+        try:
+            readable, writable, _ = select.select(
+                [sock, self._wake_r], [sock] if self.client.want_write() else [], [], timeout)
+        except (OSError, ValueError, TypeError):
+            # socket closed meanwhile
+            return mqtt.MQTT_ERR_CONN_LOST
+        if self._wake_r in readable:
+            try:
+                while self._wake_r.recv(4096):
+                    pass
+            except OSError:
+                pass
+        if sock in readable or (hasattr(sock, "pending") and sock.pending()):
+            rc = self.client.loop_read()
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                return rc
+        if sock in writable:
+            rc = self.client.loop_write()
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                return rc
+        return self.client.loop_misc()
+
+    def _on_publish(self, client, userdata, mid):
+        on_publish(client, userdata, mid)
+        if self.on_ack is not None:
+            self.on_ack(mid)
+        if not self._timed:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            sent = self._sent.pop(mid, None)
+            if sent is None:
+                # paho may write (and ack qos 0) inside publish()
+                self._acked[mid] = now
+        if sent is not None:
+            self._ack_latency.observe(now - sent)
+
+    def _send(self, topic, payload, qos, retain):
+        start = time.perf_counter() if self._timed else None
+        info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return info
+        self._published.inc()
+        if start is not None:
+            with self._lock:
+                acked = self._acked.pop(info.mid, None)
+                if acked is None:
+                    self._sent[info.mid] = start
+            if acked is not None:
+                self._ack_latency.observe(acked - start)
+        return info
+
+    def _drain(self):
+        """Hand the queued messages to paho, in the network thread; a few at
+        a time, so the socket is read in between."""
+        for _ in range(1000):
+            if not self._connected.is_set():
+                break
+            with self._lock:
+                if self._direct:
+                    item, kept = self._direct.popleft(), False
+                elif self.queue:
+                    item, kept = self.queue.popleft(), True
+                else:
+                    break
+            topic, payload, qos, retain, on_sent = item
+            info = self._send(topic, payload, qos, retain)
+            sent = info.rc == mqtt.MQTT_ERR_SUCCESS
+            if on_sent is not None:
+                on_sent(info.mid if sent else None)
+            if not sent:
+                if kept:
+                    with self._lock:
+                        self.queue.appendleft(item)
+                break
+
+    def start(self):
+        """Connect and start the network thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Queue a message for the network thread, never blocks; kept until
+        it is sent, also across disconnects (the oldest are dropped when the
+        queue is full)."""
+        with self._lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+                self._dropped.inc()
+            self.queue.append((topic, payload, qos, retain, None))
+        self._wake()
+
+    def connected(self):
+        return self._connected.is_set()
+
+    def try_publish(self, topic, payload=None, qos=0, on_sent=None):
+        """Queue a message only if connected, True if queued. The network
+        thread calls on_sent(mid) once paho took it (see on_ack), or
+        on_sent(None) if it refused it; a message still queued when the
+        connection drops is forgotten (on_lost is called)."""
+        if not self._connected.is_set():
+            return False
+        with self._lock:
+            self._direct.append((topic, payload, qos, False, on_sent))
+        self._wake()
+        return True
+
+    def stop(self, timeout=10.0):
+        """Try to send the queued fixes, then disconnect and stop the thread."""
+        deadline = time.monotonic() + timeout
+        while self.queue and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stopped.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+        self.client.disconnect()
+        self._wake_r.close()
+        self._wake_w.close()
+        self._queue_gauge.remove(self._gauge_labels, self._queue_depth)
+
+    def stats(self):
+        return {
+            "connected": self._connected.is_set(),
+            "queued": len(self.queue),
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+            "jwt_refreshes": self.refreshes,
+            "jwt_seconds": self.jwt_seconds,
+        }